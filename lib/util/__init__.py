@@ -3,5 +3,14 @@
 
 from lib.util.common import *
 from lib.util.imgutil import *
+from lib.util.mapstore import *
 from lib.util.multitask import *
 from lib.util.parser import *
+from lib.util.resultcache import *
+from lib.util.sharedmem import *
+from lib.util.taskbroker import *
+from lib.util.taskcall import *
+from lib.util.taskmetrics import *
+from lib.util.taskpipeline import *
+from lib.util.taskplacement import *
+from lib.util.taskreduce import *
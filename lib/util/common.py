@@ -1,24 +1,55 @@
 #! /usr/bin/env python
 # coding: utf-8
 
+import io
 import os
+import bz2
+import glob
+import gzip
 import json
+import lzma
+import mmap
+import uuid
+import locale
 import pickle
+import shutil
+import hashlib
 import logging
+import tempfile
 import datetime
+import contextlib
 import multiprocessing
 
 import tqdm
+import numpy as np
+
+import lib.util
 
 global_lock = multiprocessing.Lock()
 
+# 文件超过这个大小时, read_list_field默认用多个进程解析
+_PARALLEL_PARSE_SIZE = 64 << 20
+
+# write_pickle_file中out-of-band的数据保存在path.<token>.buffers中, 每块数据
+# 的起始位置按照_PICKLE_BUFFER_ALIGN对齐. pickle文件的开头是(_PICKLE_BUFFERS_MAGIC,
+# token, 每块数据的位置)
+_PICKLE_BUFFERS_MAGIC = "lib.util.pickle_buffers.v1"
+_PICKLE_BUFFERS_SUFFIX = ".buffers"
+_PICKLE_BUFFER_ALIGN = 64
+
+# open_file中文件的缓冲区大小, 网络文件系统上大块读写更快
+_IO_BUFFER_SIZE = 1 << 20
+
 __all__ = (
     "prepare_dir",
     "normlize_path",
+    "open_file",
     "read_pickle_file",
     "read_json_file",
     "read_list_file",
+    "iter_list_file",
     "read_list_field",
+    "read_list_columns",
     "read_map_file",
     "write_pickle_file",
     "write_json_file",
@@ -56,16 +87,144 @@ def normlize_path(path):
     return path
 
 
+def _get_pickle_buffers_path(path, token):
+    return f"{path}.{token}{_PICKLE_BUFFERS_SUFFIX}"
+
+
+def _is_pickle_buffers_header(obj):
+    return isinstance(obj, tuple) and len(obj) == 3 and \
+        obj[0] == _PICKLE_BUFFERS_MAGIC
+
+
+def _load_pickle_buffers(srcfile, path, header):
+    """将out-of-band的数据mmap进来, 然后读取header之后的pickle数据流."""
+
+    _, token, index = header
+    buffers_path = _get_pickle_buffers_path(path, token)
+    if not os.path.exists(buffers_path):
+        raise FileNotFoundError(
+            f"Missing out-of-band buffers of {path}: {buffers_path}")
+    with open(buffers_path, "rb") as bufferfile:
+        size = os.fstat(bufferfile.fileno()).st_size
+        # 空文件不能mmap. 用写时复制的方式映射, 修改数组不会写回文件
+        buffer = mmap.mmap(bufferfile.fileno(), 0, access=mmap.ACCESS_COPY) \
+            if size else b""
+    # mmap在所有的视图都释放之后才会关闭
+    view = memoryview(buffer)
+    buffers = [view[start:start + length] for start, length in index]
+    return pickle.load(srcfile, buffers=buffers)
+
+
+def _remove_pickle_buffers(path, keep=None):
+    """删除path之前写入的out-of-band数据, keep为当前使用的文件."""
+
+    pattern = _get_pickle_buffers_path(glob.escape(path), "*")
+    for buffers_path in glob.glob(pattern):
+        if buffers_path == keep: continue
+        try:
+            os.unlink(buffers_path)
+        except FileNotFoundError:
+            pass
+
+
+def _open_gzip(raw, mode, level):
+    level = 6 if level is None else level
+    return gzip.GzipFile(fileobj=raw, mode=mode, compresslevel=level)
+
+
+def _open_bz2(raw, mode, level):
+    return bz2.BZ2File(raw, mode, compresslevel=9 if level is None else level)
+
+
+def _open_xz(raw, mode, level):
+    return lzma.LZMAFile(raw, mode, preset=level)
+
+
+def _open_zstd(raw, mode, level):
+    import zstandard  # pylint: disable=import-outside-toplevel
+    if mode == "rb":
+        # stream_reader没有实现readline和peek, pickle读取时需要它们
+        reader = zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.BufferedReader(reader)
+    level = 3 if level is None else level
+    return zstandard.ZstdCompressor(level=level).stream_writer(raw)
+
+
+def _open_lz4(raw, mode, level):
+    import lz4.frame  # pylint: disable=import-outside-toplevel
+    return lz4.frame.LZ4FrameFile(raw, mode, compression_level=level or 0)
+
+
+# 按照扩展名压缩和解压. zstandard和lz4是可选的依赖, 用到时才import
+_CODECS = {
+    ".gz": _open_gzip,
+    ".bz2": _open_bz2,
+    ".xz": _open_xz,
+    ".zst": _open_zstd,
+    ".lz4": _open_lz4,
+}
+
+
+def _is_compressed(path):
+    return os.path.splitext(path)[1] in _CODECS
+
+
+def _open_stream(stack, target, path, mode, level):
+    """打开target, 按照path的扩展名压缩或者解压. 所有的流都由stack关闭."""
+
+    binary_mode = mode[0] + "b"
+    stream = stack.enter_context(
+        open(target, binary_mode, buffering=_IO_BUFFER_SIZE))
+    codec = _CODECS.get(os.path.splitext(path)[1])
+    if codec is not None:
+        level = level if mode[0] == "w" else None
+        stream = stack.enter_context(codec(stream, binary_mode, level))
+    # 编码和换行符的处理和内置的open一样
+    if mode in ("r", "w"):
+        stream = stack.enter_context(io.TextIOWrapper(stream))
+    return stream
+
+
+@contextlib.contextmanager
+def open_file(path, mode="r", *, level=None):
+    """Open file, compressed by extension and written atomically.
+
+    按照扩展名(.gz, .bz2, .xz, .zst, .lz4)压缩和解压, level为压缩级别, None
+    表示各种格式默认的级别. 写入时先写到同一个目录下的临时文件, 正常结束之后
+    再重命名, 任务中途被杀掉也不会留下不完整的文件.
+    """
+
+    assert mode in ("r", "rb", "w", "wb"), f"Unsupported mode: {mode}"
+    target = path
+    if mode[0] == "w":
+        prepare_dir(path)
+        target = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with contextlib.ExitStack() as stack:
+            yield _open_stream(stack, target, path, mode, level)
+        if target != path: os.replace(target, path)
+    except BaseException:
+        if target != path and os.path.exists(target): os.unlink(target)
+        raise
+
+
 def read_pickle_file(path, *, check=True):
-    "Read file in pickle format."
+    """Read file in pickle format.
+
+    由write_pickle_file(out_of_band=True)写入的文件, 其中的大数组是文件的
+    mmap视图, 不需要读入内存.
+    """
 
     if check:
         assert path and os.path.exists(path), \
             f"Failed to read file: {path}"
     if not path: return None
     if not os.path.exists(path): return None
-    with open(path, "rb") as srcfile:
-        return pickle.load(srcfile)
+    with open_file(path, "rb") as srcfile:
+        data = pickle.load(srcfile)
+        # 普通格式的文件只有一个对象, out-of-band格式以header开头
+        if not _is_pickle_buffers_header(data): return data
+        return _load_pickle_buffers(srcfile, path, data)
 
 
 def read_json_file(path, *, check=True):
@@ -76,67 +235,299 @@ def read_json_file(path, *, check=True):
             f"Failed to read file: {path}"
     if not path: return None
     if not os.path.exists(path): return None
-    with open(path, "rb") as srcfile:
+    with open_file(path, "rb") as srcfile:
         return json.load(srcfile)
 
 
+def _parse_list_lines(lines, sep):
+    for line in lines:
+        line = line.strip()
+        # 去掉空行和注释行(以'#'开头的行)
+        if not line or line.startswith("#"): continue
+        if isinstance(sep, str):
+            line = tuple(filter(None, line.split(sep)))
+        yield line
+
+
+class _ListFileIterator:
+    """iter_list_file返回的迭代器, 读完之后自动关闭文件.
+
+    提前结束迭代时需要调用close, 或者在with语句中使用, 否则文件要等到垃圾
+    回收时才关闭.
+    """
+
+    def __init__(self, path, sep):
+        with contextlib.ExitStack() as stack:
+            srcfile = _open_stream(stack, path, path, "r", None)
+            self.lines = _parse_list_lines(srcfile, sep)
+            # 打开成功之后由self.stack负责关闭
+            self.stack = stack.pop_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.lines)
+        except StopIteration:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+
+def _get_field(line, field):
+    if isinstance(field, int): return line[field]
+    return [line[i] for i in field]
+
+
+def _split_list_file(path, num_chunks):
+    """按照行的边界将文件分成最多num_chunks段, 返回[(start, stop), ...]."""
+
+    with open(path, "rb") as srcfile, \
+            mmap.mmap(srcfile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        size = len(buffer)
+        bounds = [0]
+        for i in range(1, num_chunks):
+            start = max(size * i // num_chunks, bounds[-1])
+            pos = buffer.find(b"\n", start)
+            if pos < 0: break
+            bounds.append(pos + 1)
+        bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def _read_list_chunk(start, stop, path, sep, field):
+    """解析文件中[start, stop)之间的行, 只返回需要的字段."""
+
+    with open(path, "rb") as srcfile, \
+            mmap.mmap(srcfile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        text = buffer[start:stop].decode(locale.getpreferredencoding(False))
+    # 和open(path, "r")一样处理各种换行符
+    lines = io.StringIO(text, newline=None)
+    return [_get_field(l, field) for l in _parse_list_lines(lines, sep)]
+
+
+def _to_columns(lines, dtypes):
+    # 按列转置之后由numpy批量转换类型, 不在python中逐个转换
+    columns = zip(*lines) if lines else [()] * len(dtypes)
+    return [np.array(c, dtype=t) for c, t in zip(columns, dtypes)]
+
+
+def _read_column_chunk(start, stop, path, sep, fields, dtypes):
+    """同_read_list_chunk, 每个字段转换为一个numpy数组."""
+
+    return _to_columns(_read_list_chunk(start, stop, path, sep, fields), dtypes)
+
+
+def _get_parse_workers(path, num_workers):
+    # daemon进程(比如multiprocessing.Pool中的worker)不能创建子进程
+    if multiprocessing.current_process().daemon: return 1
+    # 压缩的文件不能按照字节分段, 只能顺序解析
+    if _is_compressed(path) or os.path.getsize(path) == 0: return 1
+    if num_workers is not None: return num_workers
+    if os.path.getsize(path) < _PARALLEL_PARSE_SIZE: return 1
+    return len(lib.util.get_available_cpus())
+
+
 def read_list_file(path, sep=None, *, check=True):
     "Read file as a list of strings."
 
+    lines = iter_list_file(path, sep, check=check)
+    if lines is None: return None
+    return list(lines)
+
+
+def iter_list_file(path, sep=None, *, check=True):
+    """Iterate over lines of file, same as read_list_file but lazily.
+
+    提前结束迭代时调用返回值的close, 或者用with语句关闭文件.
+    """
+
     if check:
         assert path and os.path.exists(path), \
             f"Failed to read file: {path}"
     if not path: return None
     if not os.path.exists(path): return None
-    with open(path, "r") as srcfile:
-        lines = [l.strip() for l in srcfile]
-        # 去掉空行和注释行(以'#'开头的行)
-        lines = [l for l in lines if l and (not l.startswith("#"))]
-    if isinstance(sep, str):
-        lines = [l.split(sep) for l in lines]
-        lines = [tuple(filter(None, l)) for l in lines]
-    return lines
+    return _ListFileIterator(path, sep)
 
 
-def read_list_field(path, field=0, sep=" ", *, check=True):
-    "Read file and extract filed."
+def read_list_field(path, field=0, sep=" ", *, check=True, num_workers=None):
+    """Read file and extract filed.
 
-    lines = read_list_file(path, sep, check=check)
-    if not lines: return None
-    if isinstance(field, int):
-        return [n[field] for n in lines]
-    return [[n[i] for i in field] for n in lines]
+    只保存需要的字段. num_workers大于1时, 文件按照行的边界分段, 由多个进程
+    并行解析. 默认在文件较大时使用所有的CPU. daemon进程中不能创建子进程,
+    这时总是顺序解析.
+    """
 
+    lines = iter_list_file(path, sep, check=check)
+    if lines is None: return None
+    num_workers = _get_parse_workers(path, num_workers)
+    if num_workers > 1:
+        lines.close()
+        # 分段比进程数多一些, 避免各段的行数不均匀
+        ranges = _split_list_file(path, num_workers * 4)
+        chunks = lib.util.TaskPool.map(
+            num_workers, _read_list_chunk, ranges, args=(path, sep, field))
+        fields = [f for chunk in chunks for f in chunk]
+    else:
+        fields = [_get_field(l, field) for l in lines]
+    return fields or None
+
+
+def _get_columns_cache(cache_dir, path, fields, dtypes, sep):
+    """缓存的目录, 文件的大小或者修改时间变化之后自动失效."""
+
+    stat = os.stat(path)
+    identity = f"{normlize_path(path)}:{stat.st_size}:{stat.st_mtime_ns}:"
+    identity += f"{fields}:{[t.str for t in dtypes]}:{sep!r}"
+    key = hashlib.blake2b(identity.encode(), digest_size=16).hexdigest()
+    return os.path.join(os.path.expanduser(cache_dir), key)
+
+
+def _load_columns_cache(cache, num_columns):
+    columns = []
+    for i in range(num_columns):
+        column = os.path.join(cache, f"{i}.npy")
+        # 用mmap加载, 只读取用到的部分. "c"模式下修改数组不会写回缓存
+        try:
+            columns.append(np.load(column, mmap_mode="c"))
+        except ValueError:
+            # object类型的数组是pickle格式, 不能mmap
+            columns.append(np.load(column, allow_pickle=True))
+    return columns
+
+
+def _save_columns_cache(cache, columns):
+    """先写到临时目录再重命名, 多个进程同时写时只保留一份."""
+
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    temp = tempfile.mkdtemp(dir=os.path.dirname(cache), suffix=".tmp")
+    try:
+        for i, column in enumerate(columns):
+            np.save(os.path.join(temp, f"{i}.npy"), column)
+        os.rename(temp, cache)
+    except OSError:
+        if not os.path.isdir(cache): raise
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+
+
+def read_list_columns(path, fields=0, dtypes=str, sep=" ", *, check=True,
+                      num_workers=None, cache_dir=None):  # yapf: disable
+    """Read fields of file as typed numpy arrays.
+
+    fields为int时返回一个数组, 为list时返回每个字段的数组. dtypes为每个字段
+    的类型, 也可以是所有字段共用的一个类型. 字符串到数值的转换由numpy批量完
+    成, num_workers同read_list_field. cache_dir不为None时, 解析的结果以.npy
+    格式缓存在cache_dir中, 再次读取同一个文件时直接通过mmap加载.
+    """
 
-def read_map_file(path, vtype=str, *, check=True):
-    "Read file as a dictionay."
+    if check:
+        assert path and os.path.exists(path), \
+            f"Failed to read file: {path}"
+    if not path: return None
+    if not os.path.exists(path): return None
+    single = isinstance(fields, int)
+    fields = [fields] if single else list(fields)
+    if not isinstance(dtypes, (tuple, list)):
+        dtypes = [dtypes] * len(fields)
+    assert len(dtypes) == len(fields), "Each field needs a dtype."
+    dtypes = [np.dtype(t) for t in dtypes]
+
+    cache = None
+    if cache_dir is not None:
+        cache = _get_columns_cache(cache_dir, path, fields, dtypes, sep)
+        if os.path.isdir(cache):
+            columns = _load_columns_cache(cache, len(fields))
+            return columns[0] if single else columns
+    num_workers = _get_parse_workers(path, num_workers)
+    if num_workers > 1:
+        ranges = _split_list_file(path, num_workers * 4)
+        chunks = lib.util.TaskPool.map(
+            num_workers,
+            _read_column_chunk,
+            ranges,
+            args=(path, sep, fields, dtypes),
+        )
+    else:
+        lines = [_get_field(l, fields) for l in _ListFileIterator(path, sep)]
+        chunks = [_to_columns(lines, dtypes)]
+    columns = [np.concatenate(c) for c in zip(*chunks)]
+    # 和read_list_field一样, 没有内容时返回None
+    if len(columns[0]) == 0: return None
+    if cache is not None: _save_columns_cache(cache, columns)
+    return columns[0] if single else columns
 
-    lines = read_list_file(path, " ", check=check)
-    if not lines: return None
-    return {k: vtype(v) for k, v in lines}
 
+def read_map_file(path, vtype=str, *, check=True):
+    "Read file as a dictionay."
 
-def write_pickle_file(data, path):
-    """Write data to pickle file."""
+    lines = iter_list_file(path, " ", check=check)
+    if lines is None: return None
+    mapping = {k: vtype(v) for k, v in lines}
+    return mapping or None
+
+
+def _dump_pickle_buffers(data, path):
+    # 读取时需要mmap, 所以不能压缩
+    assert not _is_compressed(path), f"Cannot compress out-of-band: {path}"
+    buffers = []
+    stream = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    # 每次写入使用新的文件名, pickle文件重命名之前旧的一对文件仍然完整, 之后
+    # 新的一对文件也是完整的, 所以任务中途被杀掉也不会出现不匹配的两个文件
+    token = uuid.uuid4().hex
+    buffers_path = _get_pickle_buffers_path(path, token)
+    index, offset = [], 0
+    with open_file(buffers_path, "wb") as dstfile:
+        for buffer in buffers:
+            raw = buffer.raw()
+            padding = -offset % _PICKLE_BUFFER_ALIGN
+            dstfile.write(b"\0" * padding)
+            dstfile.write(raw)
+            index.append((offset + padding, raw.nbytes))
+            offset += padding + raw.nbytes
+    # 每块数据的位置写在文件的开头, 后面是pickle的数据流
+    with open_file(path, "wb") as dstfile:
+        header = (_PICKLE_BUFFERS_MAGIC, token, index)
+        pickle.dump(header, dstfile, protocol=2)
+        dstfile.write(stream)
+    _remove_pickle_buffers(path, keep=buffers_path)
+
+
+def write_pickle_file(data, path, *, out_of_band=False, level=None):
+    """Write data to pickle file.
+
+    out_of_band为True时使用pickle protocol 5, numpy数组等大块数据不进入
+    pickle的数据流, 而是对齐之后写入path.<token>.buffers, 读取时直接mmap.
+    复制或者移动文件时两个文件需要一起处理. 压缩和level参考open_file.
+    """
 
-    prepare_dir(path)
-    with open(path, "wb") as dstfile:
+    if out_of_band: return _dump_pickle_buffers(data, path)
+    with open_file(path, "wb", level=level) as dstfile:
         pickle.dump(data, dstfile, protocol=2)
+    # 新的文件写完之后再删除之前out-of-band格式留下的文件
+    _remove_pickle_buffers(path)
 
 
-def write_json_file(data, path):
+def write_json_file(data, path, *, level=None):
     """Write data to json file."""
 
-    prepare_dir(path)
-    with open(path, "w") as dstfile:
+    with open_file(path, "w", level=level) as dstfile:
         json.dump(data, dstfile, indent=2)
 
 
-def write_list_file(data, path, sep=" "):
+def write_list_file(data, path, sep=" ", *, level=None):
     """Write list to txt file."""
 
-    prepare_dir(path)
-    with open(path, "w") as dstfile:
+    with open_file(path, "w", level=level) as dstfile:
         for line in data:
             if isinstance(line, (tuple, list)):
                 line = sep.join([str(item) for item in line])
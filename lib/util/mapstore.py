@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""由read_map_file格式的文件生成的只读key/value存储.
+
+几千万条的barcode->label映射读成dict之后要占用好几GB的内存, 而且MapTaskPool的
+每个worker都要加载一份. MapStore.build把map文件转换成一个目录, 其中是几个紧凑的
+numpy数组:
+    * hashes.npy: 每个key的64位哈希值, 排好序.
+    * key_offsets.npy, keys.npy: 按照哈希值的顺序拼接在一起的key(utf-8编码)及其
+      在keys.npy中的起止位置.
+    * values.npy: vtype为数值类型时是对应的值; vtype为str时和key一样拼接在一起,
+      起止位置保存在value_offsets.npy中.
+
+MapStore打开时将这些文件mmap为只读的数组. 查找时先在hashes中二分查找, 再比较
+key本身, 所以不会因为哈希冲突返回错误的结果. 批量查找(lookup)中的二分查找由
+numpy完成. 所有进程映射的是同一个文件, 共享page cache中的物理内存; pickle时只
+保存路径, 所以MapStore可以直接作为MapTaskPool的task参数或者shared传给worker.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+import lib.util
+
+__all__ = ("MapStore", )
+
+
+def _hash_key(key):
+    """key的64位哈希值, 不能用hash(), 因为它在每个进程中都不一样."""
+
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _pack_strings(items):
+    """将bytes拼接成一个uint8数组, 返回(offsets, blob)."""
+
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in items], out=offsets[1:])
+    blob = np.frombuffer(b"".join(items), dtype=np.uint8)
+    return offsets, blob
+
+
+class MapStore:
+    """只读的key/value存储, 参考模块的说明. 通过MapStore.build生成.
+
+    用法和dict一样(store[key], key in store, store.get(key), len(store)等),
+    另外lookup可以批量查找. 遍历的顺序是哈希值的顺序, 和原文件的顺序无关.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, state):
+        self.path = state
+        self._open()
+
+    def _open(self):
+        meta = lib.util.read_json_file(os.path.join(self.path, "meta.json"))
+        self.vtype = meta["vtype"]
+
+        def load(name):
+            return np.load(
+                os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+        self.hashes = load("hashes")
+        self.key_offsets = load("key_offsets")
+        self.keys_blob = load("keys")
+        self.values_array = load("values")
+        self.value_offsets = None
+        if self.vtype == "str": self.value_offsets = load("value_offsets")
+
+    @classmethod
+    def build(cls, src_path, dst_path, vtype=str):
+        """将map文件src_path转换为MapStore, 保存在目录dst_path中.
+
+        vtype (type): 值的类型, str或者numpy能够转换的数值类型. 同一个key出现
+            多次时和read_map_file一样使用最后一次的值.
+        """
+
+        mapping = {}
+        for key, value in lib.util.iter_list_file(src_path, " "):
+            mapping[key.encode()] = value
+        keys = list(mapping)
+        hashes = np.array([_hash_key(k) for k in keys], dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable")
+        keys = [keys[i] for i in order]
+        values = [mapping[k] for k in keys]
+        del mapping
+
+        arrays = {"hashes": hashes[order]}
+        arrays["key_offsets"], arrays["keys"] = _pack_strings(keys)
+        if vtype is str:
+            arrays["value_offsets"], arrays["values"] = _pack_strings(
+                [v.encode() for v in values])
+            meta = {"vtype": "str"}
+        else:
+            arrays["values"] = np.array(values, dtype=vtype)
+            meta = {"vtype": arrays["values"].dtype.str}
+
+        # 先写到临时目录再重命名, 其他进程不会看到写了一半的结果
+        dst_path = os.path.normpath(dst_path)
+        lib.util.prepare_dir(dst_path)
+        temp = tempfile.mkdtemp(
+            dir=os.path.dirname(dst_path) or ".", suffix=".tmp")
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp, name + ".npy"), array)
+            with open(os.path.join(temp, "meta.json"), "w",
+                      encoding="utf-8") as dstfile:
+                json.dump(meta, dstfile)
+            if os.path.isdir(dst_path): shutil.rmtree(dst_path)
+            os.rename(temp, dst_path)
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        return cls(dst_path)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        index = self._find(key)
+        if index < 0: raise KeyError(key)
+        return self._get_value(index)
+
+    def __iter__(self):
+        return (self._get_key(i) for i in range(len(self)))
+
+    def get(self, key, default=None):
+        index = self._find(key)
+        return default if index < 0 else self._get_value(index)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (self._get_value(i) for i in range(len(self)))
+
+    def items(self):
+        for index in range(len(self)):
+            yield self._get_key(index), self._get_value(index)
+
+    def lookup(self, keys):
+        """批量查找, 返回(values, found).
+
+        found为bool数组, 表示每个key是否存在. vtype为数值类型时values为numpy
+        数组, 不存在的key对应0; vtype为str时values为list, 不存在的key对应None.
+        """
+
+        encoded = [k.encode() for k in keys]
+        hashes = np.array([_hash_key(k) for k in encoded], dtype=np.uint64)
+        indices = np.searchsorted(self.hashes, hashes)
+        indices = np.minimum(indices, max(len(self) - 1, 0))
+        # 哈希值相同时还需要比较key本身
+        found = np.zeros(len(encoded), dtype=bool)
+        if len(self) > 0: found = self.hashes[indices] == hashes
+        for i in np.flatnonzero(found):
+            if self._get_key_bytes(indices[i]) != encoded[i]:
+                indices[i] = self._find_bytes(encoded[i], hashes[i])
+                found[i] = indices[i] >= 0
+        if self.vtype == "str":
+            values = [self._get_value(i) if f else None
+                      for i, f in zip(indices, found)]  # yapf: disable
+        else:
+            values = np.zeros(len(encoded), dtype=self.values_array.dtype)
+            values[found] = self.values_array[indices[found]]
+        return values, found
+
+    def _find(self, key):
+        encoded = key.encode()
+        return self._find_bytes(encoded, _hash_key(encoded))
+
+    def _find_bytes(self, encoded, key_hash):
+        """返回key的序号, 不存在时返回-1."""
+
+        key_hash = np.uint64(key_hash)
+        index = int(np.searchsorted(self.hashes, key_hash))
+        while index < len(self) and self.hashes[index] == key_hash:
+            if self._get_key_bytes(index) == encoded: return index
+            index += 1
+        return -1
+
+    def _get_key_bytes(self, index):
+        start, stop = self.key_offsets[index:index + 2]
+        return self.keys_blob[start:stop].tobytes()
+
+    def _get_key(self, index):
+        return self._get_key_bytes(index).decode()
+
+    def _get_value(self, index):
+        if self.vtype != "str": return self.values_array[index].item()
+        start, stop = self.value_offsets[index:index + 2]
+        return self.values_array[start:stop].tobytes().decode()
+
+
+if __name__ == "__main__":
+    pass
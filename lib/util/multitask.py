@@ -10,171 +10,836 @@
 这里实现两个版本, 分别对应map操作和reduce操作. 每一种操作又实现了单进程和多进
 程两个版本. 如果只有一个进程, 则不启动multiprocessing, 直接在当前进程中计算.
 
+多进程版本的worker可以是进程, 也可以是线程, 通过参数backend指定:
+    "process": 每个worker是一个子进程, 样本和结果需要pickle.
+    "thread": 每个worker是一个线程, 适用于cv2, numpy, IO等会释放GIL的任务,
+        没有启动进程和pickle的开销.
+    "inline": 不启动任何worker, 在当前线程中用第一个初始化参数计算.
+默认情况下, 只有一个初始化参数时为"inline", 否则为"process".
+
 map操作实现了类版本和函数版本. reduce操作只实现了类版本.
+reduce操作在lib.util.taskreduce中, map和reduce共用的部分在lib.util.taskcall中.
+
+reduce操作默认返回每个worker的结果组成的list, 由调用者自己合并. 如果task类定义
+了combine(self, result)方法, 则worker之间两两并行合并(树形归并), get_result直接
+返回最终的结果, 部分结果不需要经过主进程. 如果task类定义了
+accumulate_batch(self, samples)方法, 则worker每次用一个chunk的样本调用它, 而不
+是逐个调用accumulate, 方便用numpy做向量化的统计.
+
+reduce操作可以指定key函数, 这时样本按照hash(key(sample))分发给固定的worker,
+每个worker负责的key互不相交, 比如按key统计时, 各个worker的结果直接取并集即可.
+
+map操作除了一次性处理整个list的process之外, 还提供了流式接口imap和
+imap_unordered, 可以处理任意iterable, 并且在结果完成时就返回, 内存占用只和
+同时在处理的样本数相关.
+
+多进程版本中, 样本按chunk分发给子进程, 以摊薄队列和pickle的固定开销. chunk的
+大小根据实测的单样本处理时间和样本数据量自适应调整, 参考taskcall.ChunkSizer. process
+可以指定每个样本的代价, 代价大的样本优先分发, 以减少最后的长尾.
+
+样本和结果中包含大的numpy数组(比如解码之后的图片)时, 可以指定transport="shm",
+这时大数组通过共享内存传递, 队列中只传递句柄, 参考lib.util.sharedmem.
+
+所有的接口都有对应的asyncio版本(aprocess, aimap, aaccumulate等), 等待结果时
+直接挂在event loop上, 不阻塞event loop, 也不占用额外的线程.
+
+MapTaskPool.warm_pool和MapTaskPool.map(keep_alive=...)会缓存初始化好的pool,
+之后相同参数的调用直接复用, 不需要重新启动进程和初始化task. 空闲超时的pool会
+被自动关闭.
+
+每个pool的metrics记录了各个worker处理的样本数, 处理时间, 等待时间, 通信的数据
+量等, 参考lib.util.taskmetrics.
+
+map操作可以指定cache, 这时worker先查询磁盘上的结果缓存, 只计算没有缓存的样本,
+参考lib.util.resultcache.
+
+task出错不会影响其他样本: process抛出的异常在worker中被捕获, 重试max_retries次
+之后仍然失败的样本返回TaskError. on_error为"raise"(默认)时调用者在这个样本处
+收到异常, 为"return"时TaskError作为这个样本的结果返回(reduce操作中记录在
+pool.errors中). map操作的worker进程异常退出(比如在cv2中segfault)时, 队列可能
+已经损坏, 主进程会换成新的队列并重启所有worker, 把退出的worker正在处理的样本
+逐个重新发送, 所以一个有问题的样本只影响它自己. reduce操作的worker退出时部分
+结果已经丢失, 这时直接抛出异常, 而不是一直等待.
+
+注意on_error为"raise"时, 进程和线程版本中调用者收到的是TaskError, 而不是task原来
+抛出的异常类型, 需要区分异常类型的调用者应该检查TaskError.__cause__. 线程版本中
+__cause__为原来的异常对象; 进程版本中异常不一定能pickle, 所以__cause__为None,
+原来的异常类型和信息只保存在message和details中. inline版本在当前线程中计算, 和
+之前的版本一样直接抛出task原来的异常.
+
+map操作可以指定shared, 即所有worker共享的只读数据(比如很大的查找表或者模型),
+它在主进程中只构造一次, 作为关键字参数shared传给task类的构造函数(函数版本中传
+给函数), 每个worker的初始化参数只需要包含真正不同的部分, 比如GPU编号. 线程版本
+直接共享同一个对象. 进程版本以fork方式启动时, 子进程直接继承主进程的内存, 只读
+的数据不会被复制(copy-on-write). 注意python对象的引用计数也会写内存, 所以大块的
+数据最好保存在numpy数组中. 以spawn或者forkserver方式启动时, 其中的大数组放入共享
+内存, 所有worker映射同一份数据, 参考lib.util.SharedState.
+
+map操作可以开启推测执行(speculate): 所有样本都已经发出并且队列已经空了之后, 如果
+某个chunk的运行时间远超过其他样本的处理时间(比如worker卡在很慢的磁盘上), 就把它
+再发送一份给空闲的worker, 先完成的一份有效, 另一份的结果被丢弃. 这只适用于结果
+确定并且没有副作用的task.
+
+进程版本的worker在创建task之前, 按照placement限制cv2, BLAS, OpenMP等库的线程数,
+也可以将worker绑定到指定的CPU或者NUMA节点上. 默认每个worker的线程数为可用的CPU
+数除以worker数, 避免线程总数远超CPU数, 参考lib.util.taskplacement.
+
+MapTaskBroker通过TCP把map操作的队列提供给其他机器上的worker, 参考
+lib.util.taskbroker.
+
+Pipeline将多个MapTaskPool串联起来, 各个stage同时运行, 参考
+lib.util.taskpipeline.
 """
 
+import os
 import time
+import queue
+import atexit
+import hashlib
+import asyncio
+import logging
+import pickle
+import itertools
+import threading
+import contextlib
 import multiprocessing
 
 import lib.util
+from lib.util.taskcall import HEALTH_CHECK_INTERVAL
+from lib.util.taskcall import MapCall
+from lib.util.taskcall import TaskError
+from lib.util.taskcall import ajoin
+from lib.util.taskcall import call_with_retry
+from lib.util.taskcall import close_state
+from lib.util.taskcall import create_queue
+from lib.util.taskcall import create_slot
+from lib.util.taskcall import create_task
+from lib.util.taskcall import decode
+from lib.util.taskcall import encode
+from lib.util.taskcall import estimate_size
+from lib.util.taskcall import get_backend
+from lib.util.taskcall import get_cache
+from lib.util.taskcall import get_length
+from lib.util.taskcall import get_limits
+from lib.util.taskcall import get_on_error
+from lib.util.taskcall import get_transport
+from lib.util.taskcall import iter_samples
+from lib.util.taskcall import load_state
+from lib.util.taskcall import raise_inline
+from lib.util.taskcall import share_state
+from lib.util.taskcall import should_measure
+from lib.util.taskcall import watch_queue
+
+__all__ = ("MapTaskPool", "TaskPool")
+
+# 推测执行时检查chunk运行时间的间隔
+_SPECULATE_INTERVAL = 0.1
 
-__all__ = ("MapTaskPool", "ReduceTaskPool", "TaskPool")
 
 ################################ map operation #################################
 
 
-class MapTaskProcess(multiprocessing.Process):
-    """进程类, 对应map操作."""
+class MapTaskWorker:
+    """worker的基类, 对应map操作. 子类需要同时继承Process或者Thread."""
 
-    def __init__(self, task_class, task_args, input_queue, output_queue):
+    def __init__(self, task_class, task_args, input_queue, output_queue,
+                 transport=None, worker_id=0, cache=None, slot=None,
+                 max_retries=0, shared=None, limits=None,
+                 task_key=None):  # yapf: disable
         super().__init__()
         assert hasattr(task_class, "process")
+        assert cache is None or task_key is not None
         self.task_class = task_class
         self.task_args = task_args
         self.input_queue = input_queue
         self.output_queue = output_queue
+        self.transport = transport
+        self.worker_id = worker_id
+        self.cache = cache
+        self.task_key = task_key
+        self.slot = slot
+        self.max_retries = max_retries
+        self.shared = shared
+        self.limits = limits
 
     def run(self):
-        if isinstance(self.task_args, tuple):
-            task = self.task_class(*self.task_args)
-        else:
-            task = self.task_class(self.task_args)
+        if self.limits: lib.util.apply_worker_limits(*self.limits)
+        shared = load_state(self.shared)
+        task = create_task(self.task_class, self.task_args, shared)
+        metrics = lib.util.WorkerMetrics(self.worker_id)
+        bytes_in, bytes_out = 0, 0
+        # 输入为(sent_time, (chunk_id, [(sid, sample), ...])), None表示退出.
+        # 输出为(chunk_id, [(sid, result), ...], durations, metrics),
+        # durations为每个样本的处理时间, 用于调整chunk大小和估计样本的代价.
+        # 处理失败的样本, result为TaskError.
         while True:
-            sid, sample = self.input_queue.get()
-            if sample is None: break
-            if isinstance(sample, tuple):
-                self.output_queue.put((sid, task.process(*sample)))
-            else:
-                self.output_queue.put((sid, task.process(sample)))
+            start = time.perf_counter()
+            chunk = self.input_queue.get()
+            metrics.idle_time += time.perf_counter() - start
+            if chunk is None: break
+            sent_time, (chunk_id, chunk) = chunk
+            if self.slot is not None:
+                # 先写时间, 主进程读到新的时间和旧的chunk时不会误判
+                self.slot[1] = time.time()
+                self.slot[0] = chunk_id
+            metrics.queue_wait += max(time.time() - sent_time, 0.0)
+            results, durations = [], []
+            for sid, sample in chunk:
+                start = time.perf_counter()
+                sample = decode(self.transport, sample)
+                decoded = time.perf_counter()
+                hit, result = call_with_retry(
+                    task, sample, self.cache, self.task_key, self.max_retries)
+                processed = time.perf_counter()
+                results.append((sid, encode(self.transport, result)))
+                durations.append(time.perf_counter() - start)
+                metrics.task_time += processed - decoded
+                metrics.serialize_time += durations[-1] - processed + decoded
+                metrics.cache_hits += hit
+            # 数据量只用第一个样本估计, 并且只是偶尔测量, 避免额外的pickle开销
+            if should_measure(metrics.chunks + 1):
+                bytes_in = estimate_size(chunk[0][1])
+                bytes_out = estimate_size(results[0][1])
+            metrics.bytes_in += bytes_in * len(chunk)
+            metrics.bytes_out += bytes_out * len(chunk)
+            metrics.samples += len(chunk)
+            metrics.chunks += 1
+            metrics.tick()
+            self.output_queue.put((chunk_id, results, durations, metrics))
+
+
+class MapTaskProcess(MapTaskWorker, multiprocessing.Process):
+    """进程类, 对应map操作."""
+
+
+class MapTaskThread(MapTaskWorker, threading.Thread):
+    """线程类, 对应map操作.
+
+    daemon线程, 没有finish的pool(比如调用者抛出了异常)不会阻塞解释器退出.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.daemon = True
 
 
 class ProxyMapTaskClass:
     """将函数包装成类. 对应map操作."""
 
-    def __init__(self, taskfun, args):
+    def __init__(self, taskfun, args, shared=None):
         self.args = args if isinstance(args, tuple) else (args,)
+        self.kwargs = {} if shared is None else {"shared": shared}
         self.taskfun = taskfun
 
     def process(self, *sample):
-        return self.taskfun(*sample, *self.args)
+        return self.taskfun(*sample, *self.args, **self.kwargs)
+
+
+class _CostModel:
+    """按照task的名字记录每个样本的处理时间, 用来估计之后运行时样本的代价.
+
+    数据保存在$TASKPOOL_CACHE_DIR/costs/<task_name>.json中, 默认的目录为
+    ~/.cache/taskpool. 样本用repr的md5作为key, 最多保存max_entries个样本,
+    超出时删除最早记录的样本. 没有记录的样本使用已知代价的中位数.
+    """
+
+    def __init__(self, task_name, max_entries=1000000):
+        root = os.environ.get("TASKPOOL_CACHE_DIR", "~/.cache/taskpool")
+        root = os.path.expanduser(root)
+        self.path = os.path.join(root, "costs", f"{task_name}.json")
+        self.max_entries = max_entries
+        self.costs = lib.util.read_json_file(self.path, check=False) or {}
+
+    @staticmethod
+    def get_key(sample):
+        return hashlib.md5(repr(sample).encode()).hexdigest()
+
+    def estimate(self, samples):
+        known = sorted(self.costs.values())
+        default = known[len(known) // 2] if known else 0.0
+        return [self.costs.get(self.get_key(s), default) for s in samples]
+
+    def update(self, samples, durations):
+        for sample, duration in zip(samples, durations):
+            key = self.get_key(sample)
+            # 重新插入, 保证dict中的顺序就是记录的先后顺序
+            self.costs.pop(key, None)
+            self.costs[key] = duration
+        for key in list(self.costs)[:len(self.costs) - self.max_entries]:
+            del self.costs[key]
+        lib.util.write_json_file(self.costs, self.path)
 
 
 class MapTaskPoolSingleThread:
     """单进程TaskPool. 用于map操作."""
 
-    def __init__(self, task_class, task_args, task_name=None):
+    def __init__(self, task_class, task_args, task_name=None, cache=None,
+                 max_retries=0, on_error="raise",
+                 shared=None):  # yapf: disable
         assert hasattr(task_class, "process")
         assert isinstance(task_args, list)
         assert len(task_args) == 1
-        task_args = task_args[0]
-        if isinstance(task_args, tuple):
-            self.instance = task_class(*task_args)
-        else:
-            self.instance = task_class(task_args)
+        self.instance = create_task(task_class, task_args[0], shared)
         self.task_name = task_name or task_class.__name__
-
-    def process(self, samples):
-        results = []
+        self.max_retries = max_retries
+        self.on_error = get_on_error(on_error)
+        self.metrics = lib.util.PoolMetrics(self.task_name, "inline", 1)
+        self.cache = get_cache(cache)
+        self.task_key = None
+        if self.cache:
+            self.task_key = self.cache.get_task_keys(
+                task_class, task_args, shared)[0]
+
+    # pylint: disable=unused-argument
+    def process(self, samples, chunksize=None, cost=None):
+        # 单进程版本按照输入顺序处理, 不需要cost
         if not samples: return []
-        tracker = lib.util.get_progress_tracker(total=len(samples))
+        return list(self.imap(samples, chunksize=chunksize))
+
+    def imap(self, samples, max_pending=None, chunksize=None):
+        """流式处理样本, 参考MapTaskPoolMultiThread.imap."""
+
+        # 单进程版本不需要max_pending和chunksize, 这里对应多进程版本的接口
+        tracker = lib.util.get_progress_tracker(total=get_length(samples))
         head = f"Task {self.task_name} (single thread)"
         tracker.set_description(head)
-        for sample in samples:
-            if isinstance(sample, tuple):
-                results.append(self.instance.process(*sample))
-            else:
-                results.append(self.instance.process(sample))
-            tracker.update(1)
-        tracker.close()
-        return results
+        metrics = self.metrics.workers[0]
+        try:
+            for index, sample in enumerate(samples):
+                start = time.perf_counter()
+                hit, result = self._call(sample, index)
+                metrics.task_time += time.perf_counter() - start
+                metrics.cache_hits += hit
+                metrics.samples += 1
+                metrics.tick()
+                yield result
+                tracker.update(1)
+        finally:
+            tracker.close()
+            if self.cache: self.cache.evict()
+
+    def imap_unordered(self, samples, max_pending=None, chunksize=None):
+        # 单进程版本中, 完成顺序就是输入顺序
+        return self.imap(samples, max_pending, chunksize)
+
+    async def aprocess(self, samples, chunksize=None):
+        return [r async for r in self.aimap(samples, chunksize=chunksize)]
+
+    async def aimap(self, samples, max_pending=None, chunksize=None):
+        # 在当前线程中计算, 每处理完一个样本让出一次event loop
+        if hasattr(samples, "__aiter__"):
+            index = 0
+            async for sample in samples:
+                yield self._call(sample, index)[1]
+                index += 1
+                await asyncio.sleep(0)
+            return
+        for result in self.imap(samples):
+            yield result
+            await asyncio.sleep(0)
+
+    def aimap_unordered(self, samples, max_pending=None, chunksize=None):
+        return self.aimap(samples, max_pending, chunksize)
+
+    def _call(self, sample, index):
+        hit, result = call_with_retry(
+            self.instance, sample, self.cache, self.task_key,
+            self.max_retries)  # yapf: disable
+        if isinstance(result, TaskError):
+            result.index = index
+            if self.on_error == "raise": raise_inline(result)
+        return hit, result
 
     def finish(self):
         # 这里对应多进程版本的接口
         pass
 
+    async def afinish(self):
+        pass
 
-class MapTaskPoolMultiThread:
-    """多进程TaskPool. 用于map操作."""
 
-    def __init__(self, task_class, task_args, task_name=None):
-        assert hasattr(task_class, "process")
-        assert isinstance(task_args, list)
-        assert len(task_args) > 1
-        self.input_queue = multiprocessing.Queue()
-        self.output_queue = multiprocessing.Queue()
-
-        self.processes = []
-        for args in task_args:
-            process = MapTaskProcess(
-                task_class,
-                args,
-                self.input_queue,
-                self.output_queue,
-            )
-            self.processes.append(process)
-            process.start()
-        self.task_name = task_name or task_class.__name__
+class MapTaskDispatcher:
+    """map操作中分发样本和收集结果的部分, 不管理worker.
+
+    MapTaskPoolMultiThread和MapTaskBroker共用这部分逻辑. 子类需要实现
+    num_workers, 等待结果超时的时候调用_check_workers检查worker的状态.
+    """
+
+    def __init__(self, task_name, backend, num_workers, transport=None,
+                 cache=None, max_retries=0,
+                 on_error="raise"):  # yapf: disable
+        self.backend = backend
+        self.cache = get_cache(cache)
+        self.max_retries = max_retries
+        self.on_error = get_on_error(on_error)
+        # 推测执行中落后的结果在调用结束之后才返回, 之后的调用需要丢弃它们
+        self.late = 0
+        self.input_queue = create_queue(backend)
+        self.output_queue = create_queue(backend)
+        # 只有进程之间需要共享内存, 线程之间直接传递引用
+        if backend != "process": transport = None
+        self.transport = get_transport(transport)
+        self.task_name = task_name
+        self.metrics = lib.util.PoolMetrics(task_name, backend, num_workers)
+        # 所有调用共用chunk序号, 保证worker记录的旧序号不会和新的chunk混淆
+        self.chunk_ids = itertools.count()
+
+    @property
+    def num_workers(self):
+        raise NotImplementedError
+
+    def _check_workers(self, call):
+        """等待结果超时时调用, 返回一个包含失败样本的消息或者None."""
+
+        raise NotImplementedError
+
+    # pylint: disable=unused-argument
+    def _get_timeout(self, call):
+        return HEALTH_CHECK_INTERVAL
+
+    def _get_message(self, call):
+        """读取worker返回的消息, 等待期间检查worker的状态."""
+
+        while True:
+            try:
+                return self.output_queue.get(timeout=self._get_timeout(call))
+            except queue.Empty:
+                message = self._check_workers(call)
+                if message: return message
+
+    async def _aget_message(self, call):
+        while True:
+            try:
+                return await asyncio.wait_for(
+                    call.messages.get(), self._get_timeout(call))
+            except asyncio.TimeoutError:
+                message = self._check_workers(call)
+                if message: return message
+
+    def process(self, samples, chunksize=None, cost=None):
+        """处理所有样本, 按照输入顺序返回结果.
+
+        cost (function or bool): 样本代价的估计. 若为函数, 则代价为
+            cost(sample); 若为True, 则使用之前运行同名task时记录的处理时间.
+            代价大的样本优先分发(LPT), 避免最后只剩少数worker在处理大样本.
+        """
 
-    def process(self, samples):
-        assert self.input_queue.empty()
-        assert self.output_queue.empty()
         if not samples: return []
+        if cost is None: return list(self.imap(samples, chunksize=chunksize))
+
+        samples = list(samples)
+        model = _CostModel(self.task_name) if cost is True else None
+        costs = model.estimate(samples) if model else map(cost, samples)
+        costs = list(costs)
+        order = sorted(range(len(samples)), key=lambda i: -costs[i])
+        results = [None] * len(samples)
+        durations = [0.0] * len(samples)
+        reordered = [samples[i] for i in order]
+        # 抛出异常时立即关闭迭代器, 保证队列为空
+        with contextlib.closing(self._imap(
+                reordered, False, None, chunksize, raw=True)) as outputs:
+            for sid, result, duration in outputs:
+                if isinstance(result, TaskError):
+                    result.index = order[sid]
+                    if self.on_error == "raise": raise result
+                results[order[sid]] = result
+                durations[order[sid]] = duration
+        if model: model.update(samples, durations)
+        return results
 
-        # 这里加上样本序号, 因为要对结果排序
-        for sid, sample in enumerate(samples):
-            self.input_queue.put((sid, sample))
+    def imap(self, samples, max_pending=None, chunksize=None):
+        """流式处理样本, 按照输入顺序返回结果的迭代器.
 
-        results = []
-        num_threads = len(self.processes)
-        tracker = lib.util.get_progress_tracker(total=len(samples))
-        head = f"Task {self.task_name} (thread {num_threads})"
-        tracker.set_description(head)
-        while len(results) < len(samples):
-            if self.output_queue.empty(): time.sleep(1)
-            while not self.output_queue.empty():
-                results.append(self.output_queue.get())
-                tracker.update(1)
-        tracker.close()
+        samples (iterable): 可以是list, 也可以是generator. 样本按需读取, 不会
+            一次性全部放入队列中.
+        max_pending (int): 最多有多少个样本已经送入子进程但是结果还没有返回给
+            调用者, 默认为进程数乘以chunk大小的4倍. 因此内存占用和样本总数无关.
+        chunksize (int): 每次送给子进程的样本数, 默认根据处理时间自适应调整.
+        """
 
-        results.sort(key=lambda x: x[0])
-        results = list(list(zip(*results))[1])
-        return results
+        return self._imap(samples, True, max_pending, chunksize)
 
-    def finish(self):
+    def imap_unordered(self, samples, max_pending=None, chunksize=None):
+        """同imap, 但是按照完成顺序返回结果."""
+
+        return self._imap(samples, False, max_pending, chunksize)
+
+    def _imap(self, samples, ordered, max_pending, chunksize, raw=False):
         assert self.input_queue.empty()
-        assert self.output_queue.empty()
+        assert self.late or self.output_queue.empty()
+        call = MapCall(self, samples, ordered, max_pending, chunksize, raw)
+        samples = iter(samples)
+        try:
+            while True:
+                call.feed(samples)
+                if call.finished: break
+                yield from call.check(call.receive(self._get_message(call)))
+        finally:
+            # 调用者提前退出时, 取回所有还在处理的样本, 保证队列为空
+            while call.pending:
+                call.receive(self._get_message(call))
+            self.late += call.late
+            call.close()
+            if self.cache: self.cache.evict()
+
+    async def aprocess(self, samples, chunksize=None):
+        return [r async for r in self.aimap(samples, chunksize=chunksize)]
+
+    def aimap(self, samples, max_pending=None, chunksize=None):
+        """imap的asyncio版本: `async for result in pool.aimap(samples)`.
+
+        samples可以是iterable, 也可以是async iterable.
+        """
 
-        # 传递None让子进程退出
-        for proc in self.processes:
-            self.input_queue.put((None, None))
-        while not self.input_queue.empty():
-            time.sleep(0.1)
-        # 必须保证子进程中的queue都为空, 否则会造成死锁
+        return self._aimap(samples, True, max_pending, chunksize)
+
+    def aimap_unordered(self, samples, max_pending=None, chunksize=None):
+        return self._aimap(samples, False, max_pending, chunksize)
+
+    async def _aimap(self, samples, ordered, max_pending, chunksize):
+        assert self.input_queue.empty()
+        assert self.late or self.output_queue.empty()
+        call = MapCall(self, samples, ordered, max_pending, chunksize)
+        call.messages, call.unwatch = watch_queue(self.output_queue)
+        samples = iter_samples(samples)
+        try:
+            while True:
+                await call.afeed(samples)
+                if call.finished: break
+                message = await self._aget_message(call)
+                for result in call.check(call.receive(message)):
+                    yield result
+        finally:
+            while call.pending:
+                call.receive(await self._aget_message(call))
+            self.late += call.late
+            call.unwatch()
+            call.close()
+            if self.cache: self.cache.evict()
+
+
+class MapTaskPoolMultiThread(MapTaskDispatcher):
+    """多进程TaskPool. 用于map操作. backend为"process"或者"thread"."""
+
+    def __init__(self, task_class, task_args, task_name=None, transport=None,
+                 backend="process", cache=None, max_retries=0,
+                 on_error="raise", shared=None, placement=None,
+                 speculate=None):  # yapf: disable
+        assert hasattr(task_class, "process")
+        assert isinstance(task_args, list)
+        assert len(task_args) > 0
+        assert backend in ("process", "thread")
+        assert speculate is None or speculate > 0
+        super().__init__(
+            task_name or task_class.__name__, backend, len(task_args),
+            transport, cache, max_retries, on_error)
+        self.speculate = speculate
+
+        self.task_class = task_class
+        self.task_args = task_args
+        # 缓存的key包含shared的内容, 在主进程中计算一次
+        self.task_keys = [None] * len(task_args)
+        if self.cache:
+            self.task_keys = self.cache.get_task_keys(
+                task_class, task_args, shared)
+        # 重启worker时也使用同一份shared
+        self.shared = share_state(shared, backend)
+        self.limits = get_limits(placement, backend, len(task_args))
+        self.slots = [create_slot(backend) for _ in task_args]
+        self.processes = [None] * len(task_args)
+        for worker_id in range(len(task_args)):
+            self._start_worker(worker_id)
+
+    @property
+    def num_workers(self):
+        return len(self.processes)
+
+    def _start_worker(self, worker_id):
+        worker_class = {
+            "process": MapTaskProcess,
+            "thread": MapTaskThread,
+        }[self.backend]
+        process = worker_class(
+            self.task_class,
+            self.task_args[worker_id],
+            self.input_queue,
+            self.output_queue,
+            self.transport,
+            worker_id,
+            self.cache,
+            self.slots[worker_id],
+            self.max_retries,
+            self.shared,
+            self.limits[worker_id],
+            self.task_keys[worker_id],
+        )
+        self.processes[worker_id] = process
+        process.start()
+
+    def _respawn_workers(self, call):
+        """重启异常退出的worker, 返回一个包含失败样本的消息或者None."""
+
+        dead = [i for i, p in enumerate(self.processes) if not p.is_alive()]
+        if not dead: return None
+        crashed = {}
+        for worker_id in dead:
+            exitcode = self.processes[worker_id].exitcode
+            reason = (f"Worker {worker_id} of {self.task_name} exited "
+                      f"unexpectedly (exitcode: {exitcode})")
+            # 还没有取到样本就退出, 一般是task初始化失败, 重启也没有用
+            chunk_id = int(self.slots[worker_id][0])
+            if chunk_id < 0:
+                for process in self.processes:
+                    if process.is_alive(): process.terminate()
+                lib.util.log_and_raise_exception(
+                    f"{reason} before processing any sample.")
+            logging.warning("%s, restarting it.", reason)
+            crashed[chunk_id] = reason
+        restart = dead
+        if self.backend == "process":
+            # 进程退出时可能正持有队列的锁, 或者只写了一半的消息, 发送缓冲区中
+            # 的结果也会丢失, 所以队列不能再用. 这里结束所有worker, 换成新的
+            # 队列, 代价是所有worker重新初始化.
+            restart = range(len(self.processes))
+            for process in self.processes:
+                process.terminate()
+                process.join()
+            self._replace_queues(call)
+        for worker_id in restart:
+            self.slots[worker_id][0] = -1
+            # 新的worker从0开始计数, 之前的统计数据不能丢
+            self.metrics.retire(worker_id)
+            self._start_worker(worker_id)
+        failed = call.recover(crashed, self.backend == "process")
+        if not failed: return None
+        return None, failed, [0.0] * len(failed), None
+
+    def _replace_queues(self, call):
+        # 旧的input_queue中可能还有数据, 不能等待它的后台线程写完
+        self.input_queue.cancel_join_thread()
+        self.input_queue.close()
+        self.output_queue.close()
+        self.input_queue = create_queue(self.backend)
+        self.output_queue = create_queue(self.backend)
+        call.input_queue = self.input_queue
+        # 落后的结果随着旧的队列一起丢弃了
+        self.late, call.late = 0, 0
+        if call.unwatch:
+            call.unwatch()
+            _, call.unwatch = watch_queue(self.output_queue, call.messages)
+
+    def _speculate(self, call):
+        """样本全部发出并且队列已经空了之后, 把运行时间超过预期speculate倍的
+        chunk再发送一份, 由空闲的worker处理. 每个chunk最多发送一次副本.
+        """
+
+        if not self.speculate or not call.exhausted: return
+        expected = call.get_expected_duration()
+        if expected is None: return
+        running = {int(slot[0]): slot[1] for slot in self.slots}
+        # 还有chunk在队列中等待时, 空闲的worker会先处理它们
+        if any(i not in running for i in call.inflight): return
+        idle = sum(int(slot[0]) not in call.inflight for slot in self.slots)
+        now = time.time()
+        for chunk_id, start in sorted(running.items(), key=lambda x: x[1]):
+            if idle == 0: break
+            if chunk_id not in call.inflight or chunk_id in call.groups:
+                continue
+            limit = self.speculate * expected * len(call.inflight[chunk_id])
+            if now - start < max(limit, _SPECULATE_INTERVAL): continue
+            call.duplicate(chunk_id)
+            self.metrics.speculated += 1
+            idle -= 1
+
+    def _check_workers(self, call):
+        message = self._respawn_workers(call)
+        if message: return message
+        self._speculate(call)
+        return None
+
+    def _get_timeout(self, call):
+        # 推测执行需要更频繁地检查chunk的运行时间
+        if self.speculate and call.exhausted: return _SPECULATE_INTERVAL
+        return HEALTH_CHECK_INTERVAL
+
+    def finish(self):
+        self._stop_workers()
         for proc in self.processes:
             proc.join()
+        if self.transport: self.transport.cleanup()
+        close_state(self.shared)
+
+    async def afinish(self):
+        self._stop_workers()
+        await ajoin(self.processes)
+        if self.transport: self.transport.cleanup()
+        close_state(self.shared)
+
+    def _stop_workers(self):
+        assert self.input_queue.empty()
+        # 等待推测执行中落后的结果, 否则worker可能因为结果没有被读取而无法退出
+        while self.late > 0:
+            self.output_queue.get()
+            self.late -= 1
+        assert self.output_queue.empty()
+
+        # 传递None让子进程退出. 子进程不会再往output_queue中写数据, 所以之后
+        # 可以直接join, 不会死锁.
+        for _ in self.processes:
+            self.input_queue.put(None)
+
+
+class _WarmPoolRegistry:
+    """缓存初始化好的MapTaskPool, 供之后相同参数的调用复用.
+
+    每个pool同一时刻只能被一个调用使用, 所以同一个key可能对应多个空闲的pool.
+    空闲超过idle_timeout秒的pool会被自动关闭, 程序退出时关闭所有空闲的pool.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}  # key -> [(pool, timer), ...]
+        atexit.register(self.shutdown)
+
+    def acquire(self, key, create_pool):
+        with self.lock:
+            entries = self.idle.get(key)
+            if entries:
+                pool, timer = entries.pop()
+                if not entries: del self.idle[key]
+                timer.cancel()
+                return pool
+        return create_pool()
+
+    def release(self, key, pool, idle_timeout):
+        timer = threading.Timer(idle_timeout, self._expire, (key, pool))
+        timer.daemon = True
+        with self.lock:
+            self.idle.setdefault(key, []).append((pool, timer))
+        timer.start()
+
+    def shutdown(self):
+        with self.lock:
+            entries = sum(self.idle.values(), [])
+            self.idle.clear()
+        for pool, timer in entries:
+            timer.cancel()
+            pool.finish()
+
+    def _expire(self, key, pool):
+        with self.lock:
+            entries = self.idle.get(key, [])
+            # 找不到说明这个pool已经被重新使用或者已经关闭了
+            if pool not in [p for p, _ in entries]: return
+            entries[:] = [(p, t) for p, t in entries if p is not pool]
+            if not entries: del self.idle[key]
+        pool.finish()
+
+
+_warm_pools = _WarmPoolRegistry()
+
+
+class _IdentityKey:
+    """按对象区分的key. key持有对象的引用, 所以对象的id在key还在使用时不会被
+    复用. pool本身不一定持有参数, 比如spawn的进程版本只保留shared的副本.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, _IdentityKey) and self.obj is other.obj
+
+
+def _get_pool_key(*args):
+    """将get_pool的参数转换成可以hash的key.
+
+    每个参数单独处理: 可以hash的参数直接使用, 其余的用pickle序列化, 按内容
+    区分. 不能pickle的参数(比如包含lambda)按对象区分.
+    """
+
+    key = []
+    for arg in args:
+        try:
+            hash(arg)
+            key.append(arg)
+            continue
+        except TypeError:
+            pass
+        try:
+            key.append(("pickle", pickle.dumps(arg)))
+        except Exception:  # pylint: disable=broad-except
+            key.append(_IdentityKey(arg))
+    return tuple(key)
 
 
 class MapTaskPool:
-    """用于map操作的TaskPool入口."""
+    """用于map操作的TaskPool入口.
+
+    可以作为context manager使用, 退出时自动调用finish.
+    """
 
-    def __init__(self, task_class, task_args, task_name=None):
+    def __init__(self, task_class, task_args, task_name=None, transport=None,
+                 backend=None, cache=None, max_retries=0, on_error="raise",
+                 shared=None, placement=None, speculate=None):  # yapf: disable
         assert hasattr(task_class, "process")
         assert isinstance(task_args, list)
-        if len(task_args) == 1:
+        assert len(task_args) > 0
+        backend = get_backend(backend, len(task_args))
+        if backend == "inline":
             self.task_pool = MapTaskPoolSingleThread(
-                task_class, task_args, task_name)  # yapf: disable
-        elif len(task_args) > 1:
+                task_class, task_args[:1], task_name, cache, max_retries,
+                on_error, shared)  # yapf: disable
+        else:
             self.task_pool = MapTaskPoolMultiThread(
-                task_class, task_args, task_name)  # yapf: disable
+                task_class, task_args, task_name, transport, backend, cache,
+                max_retries, on_error, shared, placement,
+                speculate)  # yapf: disable
+
+    @property
+    def metrics(self):
+        """运行时的统计数据, 参考lib.util.PoolMetrics."""
+
+        return self.task_pool.metrics
+
+    def process(self, samples, chunksize=None, cost=None):
+        return self.task_pool.process(samples, chunksize, cost)
+
+    def imap(self, samples, max_pending=None, chunksize=None):
+        return self.task_pool.imap(samples, max_pending, chunksize)
+
+    def imap_unordered(self, samples, max_pending=None, chunksize=None):
+        return self.task_pool.imap_unordered(samples, max_pending, chunksize)
+
+    async def aprocess(self, samples, chunksize=None):
+        return await self.task_pool.aprocess(samples, chunksize)
+
+    def aimap(self, samples, max_pending=None, chunksize=None):
+        return self.task_pool.aimap(samples, max_pending, chunksize)
 
-    def process(self, samples):
-        return self.task_pool.process(samples)
+    def aimap_unordered(self, samples, max_pending=None, chunksize=None):
+        return self.task_pool.aimap_unordered(samples, max_pending, chunksize)
 
     def finish(self):
         self.task_pool.finish()
 
+    async def afinish(self):
+        await self.task_pool.afinish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
     @staticmethod
-    def get_pool(num_threads, task_class_or_fun, args=tuple(), task_name=None):
+    def get_pool(num_threads, task_class_or_fun, args=tuple(), task_name=None,
+                 transport=None, backend=None, cache=None, max_retries=0,
+                 on_error="raise", shared=None, placement=None,
+                 speculate=None):  # yapf: disable
         """函数版本的multiprocessing.Pool.
 
         task_class_or_fun (class or function):
@@ -183,177 +848,131 @@ class MapTaskPool:
             taskfun(*sample, *args).
             若为类, 则其必须包含一个成员函数: process(self, sample). 这时,
             args为类的初始化参数. 若args为tuple, 则将其展开.
+        transport (str or SharedArrayTransport): 为"shm"时, 样本和结果中的大
+            numpy数组通过共享内存传递. 默认为None, 全部通过pickle传递.
+        backend (str): "process", "thread"或者"inline", 参考模块的说明.
+        cache (str or ResultCache): 结果缓存的目录, 默认为None, 不使用缓存.
+        max_retries (int): 每个样本失败之后最多重试的次数.
+        on_error (str): "raise"或者"return", 参考模块的说明.
+        shared (object): 所有worker共享的只读数据, 作为关键字参数shared传给
+            task类的构造函数或者函数, 参考模块的说明.
+        placement (WorkerPlacement): worker的CPU绑定和原生线程数, 默认只限制
+            线程数, 参考lib.util.WorkerPlacement.
+        speculate (float): 若不为None, 则开启推测执行: 样本全部发出之后, 运行
+            时间超过预期speculate倍的chunk会再发送一份给空闲的worker, 参考模块
+            的说明. 只适用于结果确定的task, 对单进程版本无效.
         """
 
         # `task_class_or_fun`是一个class.
         # 这里隐含了, 每一个class实例的初始化参数一致
         task_name = task_name or task_class_or_fun.__name__
         if hasattr(task_class_or_fun, "process"):
-            task_args = [args] * len(num_threads)
-            return MapTaskPool(task_class_or_fun, task_args, task_name)
+            task_args = [args] * num_threads
+            return MapTaskPool(
+                task_class_or_fun, task_args, task_name, transport, backend,
+                cache, max_retries, on_error, shared, placement,
+                speculate)  # yapf: disable
         # `task_class_or_fun`是一个function
         task_args = [(task_class_or_fun, args)] * num_threads
-        return MapTaskPool(ProxyMapTaskClass, task_args, task_name)
+        return MapTaskPool(
+            ProxyMapTaskClass, task_args, task_name, transport, backend,
+            cache, max_retries, on_error, shared, placement,
+            speculate)  # yapf: disable
 
     @staticmethod
     def map(num_threads, task_class_or_fun, samples, args=tuple(),
-            task_name=None):  # yapf:disable
-        """函数版本的map. 参数请参考get_pool."""
+            task_name=None, transport=None, backend=None,
+            keep_alive=None, cost=None, cache=None, max_retries=0,
+            on_error="raise", shared=None, placement=None,
+            speculate=None):  # yapf:disable
+        """函数版本的map. 参数请参考get_pool.
+
+        keep_alive (float): 若不为None, 则复用参数相同的warm pool, 调用结束
+            之后pool保持keep_alive秒, 参考warm_pool.
+        cost (function or bool): 样本代价的估计, 参考process.
+        """
 
         task_name = task_name or task_class_or_fun.__name__
-        pool = MapTaskPool.get_pool(  # yapf: disable
-            num_threads, task_class_or_fun, args, task_name)
-        results = pool.process(samples)
-        pool.finish()
-        return results
-
-
-############################### reduce operation ###############################
-
+        if keep_alive is not None:
+            with MapTaskPool.warm_pool(
+                    num_threads, task_class_or_fun, args, task_name,
+                    transport, backend, keep_alive, cache, max_retries,
+                    on_error, shared, placement,
+                    speculate) as pool:  # yapf: disable
+                return pool.process(samples, cost=cost)
+        pool = MapTaskPool.get_pool(
+            num_threads, task_class_or_fun, args, task_name, transport,
+            backend, cache, max_retries, on_error, shared, placement,
+            speculate)  # yapf: disable
+        try:
+            return pool.process(samples, cost=cost)
+        finally:
+            pool.finish()
 
-class ReduceTaskProcess(multiprocessing.Process):
-    """进程类, 对应reduce操作."""
-
-    def __init__(self, task_class, task_args, input_queue, output_queue):
-        super().__init__()
-        assert hasattr(task_class, "accumulate")
-        assert hasattr(task_class, "get_result")
-        self.task_class = task_class
-        self.task_args = task_args
-        self.input_queue = input_queue
-        self.output_queue = output_queue
-
-    def run(self):
-        if isinstance(self.task_args, tuple):
-            task = self.task_class(*self.task_args)
-        else:
-            task = self.task_class(self.task_args)
-
-        while True:
-            sample = self.input_queue.get()
-            if sample is None:
-                self.output_queue.put(task.get_result())
-                break
-            if isinstance(sample, tuple):
-                task.accumulate(*sample)
-            else:
-                task.accumulate(sample)
-
-
-class ReduceTaskPoolSingleThread:
-    """单进程TaskPool. 用于reduce操作."""
-
-    def __init__(self, task_class, task_args, task_name=None):
-        assert hasattr(task_class, "accumulate")
-        assert hasattr(task_class, "get_result")
-        assert isinstance(task_args, list)
-        assert len(task_args) == 1
-        task_args = task_args[0]
-        if isinstance(task_args, tuple):
-            self.instance = task_class(*task_args)
-        else:
-            self.instance = task_class(task_args)
-        self.task_name = task_name or task_class.__name__
-
-    def accumulate(self, samples):
-        tracker = lib.util.get_progress_tracker(total=len(samples))
-        head = "Task ${self.task_name} (single thread)"
-        tracker.set_description(head)
-        for sample in samples:
-            if isinstance(sample, tuple):
-                self.instance.accumulate(*sample)
-            else:
-                self.instance.accumulate(sample)
-            tracker.update(1)
-        tracker.close()
-
-    def get_result(self):
-        # 这里结果是一个list, 和多进程版本保持一致
-        return [self.instance.get_result()]
-
-
-class ReduceTaskPoolMultiThread:
-    """多进程TaskPool. 用于reduce操作."""
-
-    def __init__(self, task_class, task_args, task_name=None):
-        assert hasattr(task_class, "accumulate")
-        assert hasattr(task_class, "get_result")
-        assert isinstance(task_args, list)
-        assert len(task_args) > 1
-        self.input_queue = multiprocessing.Queue()
-        self.output_queue = multiprocessing.Queue()
-
-        self.processes = []
-        for args in task_args:
-            process = ReduceTaskProcess(
-                task_class,
-                args,
-                self.input_queue,
-                self.output_queue,
-            )
-            self.processes.append(process)
-            process.start()
-        self.task_name = task_name or task_class().__name__
-
-    def accumulate(self, samples):
-        assert self.input_queue.empty()
-        for sample in samples:
-            self.input_queue.put(sample)
-
-        num_threads = len(self.processes)
-        tracker = lib.util.get_progress_tracker(total=len(samples))
-        head = f"Task {self.task_name} (thread {num_threads})"
-        tracker.set_description(head)
-        while not self.input_queue.empty():
-            processed = len(samples) - self.input_queue.qsize()
-            tracker.update(processed - tracker.n)
-            time.sleep(1)
-        tracker.close()
-
-    def get_result(self):
-        assert self.input_queue.empty()
-
-        # 传递None让子进程退出
-        for proc in self.processes:
-            self.input_queue.put(None)
-        while not self.input_queue.empty():
-            time.sleep(1)
-        results = [self.output_queue.get() for p in self.processes]
-        # 必须保证子进程中的queue都为空, 否则会造成死锁
-        for proc in self.processes:
-            proc.join()
-        return results
-
-
-class ReduceTaskPool:
-    """用于reduce操作的TaskPool入口."""
+    @staticmethod
+    @contextlib.contextmanager
+    def warm_pool(num_threads, task_class_or_fun, args=tuple(),
+                  task_name=None, transport=None, backend=None,
+                  idle_timeout=300, cache=None, max_retries=0,
+                  on_error="raise", shared=None, placement=None,
+                  speculate=None):  # yapf: disable
+        """可以复用的get_pool, 参数请参考get_pool.
+
+        用法: `with MapTaskPool.warm_pool(...) as pool: pool.process(...)`.
+        退出with之后pool并不关闭, 之后参数相同的调用直接复用这个pool. pool空闲
+        超过idle_timeout秒之后自动关闭, 也可以调用shutdown_warm_pools关闭.
+        """
 
-    def __init__(self, task_class, task_args, task_name=None):
-        assert hasattr(task_class, "accumulate")
-        assert hasattr(task_class, "get_result")
-        assert isinstance(task_args, list)
-        if len(task_args) == 1:
-            self.task_pool = ReduceTaskPoolSingleThread(
-                task_class, task_args, task_name)  # yapf: diable
-        elif len(task_args) > 1:
-            self.task_pool = ReduceTaskPoolMultiThread(
-                task_class, task_args, task_name)  # yapf disable
+        # shared可能很大, 这里按对象区分, 不序列化
+        key = _get_pool_key(
+            num_threads, task_class_or_fun, args, task_name, transport,
+            backend, cache, max_retries, on_error, _IdentityKey(shared),
+            placement, speculate)  # yapf: disable
+        pool = _warm_pools.acquire(
+            key,
+            lambda: MapTaskPool.get_pool(
+                num_threads, task_class_or_fun, args, task_name, transport,
+                backend, cache, max_retries, on_error, shared, placement,
+                speculate),
+        )  # yapf: disable
+        try:
+            yield pool
+        except BaseException:
+            # 出错的pool状态未知, 不再复用
+            pool.finish()
+            raise
+        _warm_pools.release(key, pool, idle_timeout)
 
-    def accumulate(self, samples):
-        self.task_pool.accumulate(samples)
+    @staticmethod
+    def shutdown_warm_pools():
+        """关闭所有空闲的warm pool."""
 
-    def get_result(self):
-        return self.task_pool.get_result()
+        _warm_pools.shutdown()
 
     @staticmethod
-    def reduce(num_threads, task_class, samples, task_args=tuple(),
-               task_name=None):  # yapf: disable
-        # 和map版本不同的是, reduce版本只支持class方式.
-        task_args = [task_args] * num_threads
-        task_name = task_name or task_class.__name__
-        pool = ReduceTaskPool(task_class, task_args, task_name)
-        pool.accumulate(samples)
-        return pool.get_result()
+    async def amap(num_threads, task_class_or_fun, samples, args=tuple(),
+                   task_name=None, transport=None, backend=None,
+                   keep_alive=None, cache=None, max_retries=0,
+                   on_error="raise", shared=None, placement=None,
+                   speculate=None):  # yapf:disable
+        """map的asyncio版本. 参数请参考map."""
+
+        task_name = task_name or task_class_or_fun.__name__
+        if keep_alive is not None:
+            with MapTaskPool.warm_pool(
+                    num_threads, task_class_or_fun, args, task_name,
+                    transport, backend, keep_alive, cache, max_retries,
+                    on_error, shared, placement,
+                    speculate) as pool:  # yapf: disable
+                return await pool.aprocess(samples)
+        pool = MapTaskPool.get_pool(
+            num_threads, task_class_or_fun, args, task_name, transport,
+            backend, cache, max_retries, on_error, shared, placement,
+            speculate)  # yapf: disable
+        try:
+            return await pool.aprocess(samples)
+        finally:
+            await pool.afinish()
 
 
 # 兼容原来版本
@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""MapTaskPool的结果缓存.
+
+同样的任务在大部分样本不变的情况下重新运行时, 没有必要重新计算所有样本.
+ResultCache把每个样本的结果保存在本地磁盘上, key由task的身份(类或者函数, 初始
+化参数, shared, 版本号)和样本的内容共同决定, 两者任何一个变化都不会命中旧的结果.
+修改了task的实现但是参数不变时, 需要修改version. shared中的numpy数组按照内容的
+hash区分, task的身份在主进程中计算, 每个pool只计算一次.
+
+每个结果保存为一个pickle文件, 路径为<root>/<task_key>/<sample_key[:2]>/
+<sample_key>.pkl. 写入时先写临时文件再重命名, 所以多个worker可以同时读写, 任务
+中途崩溃也不会留下不完整的结果. 命中时更新文件的修改时间, evict按照修改时间删除
+最久没有使用的结果, 直到总大小不超过max_bytes. evict需要遍历整个缓存目录, 所以
+每隔evict_interval秒最多执行一次.
+
+函数的身份除了名字之外还包括它的字节码, 常量, 默认参数和闭包中的变量, 所以名字
+相同的不同lambda不会共用结果. 闭包中的变量是可变对象(比如list)时, 其内容变化之后
+也不会命中旧的结果.
+
+初始化参数和shared中的对象用repr描述. 默认的repr中包含内存地址, 每次运行都不
+一样, 永远不会命中, 所以这时直接抛出ValueError, 需要给这样的对象定义__repr__,
+或者指定ResultCache的task_key.
+
+注意每个worker的初始化参数不同时(比如GPU编号), 每个worker有自己的task_key, 一个
+样本只能命中同一个worker之前的结果, 缓存被按照worker分开了. 这时结果通常和worker
+无关, 应该指定task_key, 让所有worker共用缓存.
+"""
+
+import os
+import re
+import time
+import types
+import pickle
+import hashlib
+import tempfile
+
+import numpy as np
+
+__all__ = ("ResultCache", )
+
+# 默认的repr, 比如<Model object at 0x7f...>
+_ADDRESS_PATTERN = re.compile(r" at 0x[0-9a-fA-F]+")
+
+
+def _describe_code(code):
+    consts = [
+        _describe_code(c) if isinstance(c, types.CodeType) else repr(c)
+        for c in code.co_consts
+    ]
+    return f"{code.co_code.hex()}:{consts}:{code.co_names}"
+
+
+def _describe_function(fun, seen):
+    """函数的名字, 字节码, 默认参数和闭包中的变量."""
+
+    cells = []
+    for cell in fun.__closure__ or ():
+        try:
+            cells.append(cell.cell_contents)
+        except ValueError:
+            # 还没有赋值的变量
+            cells.append(None)
+    seen = seen | {id(fun)}
+    parts = (
+        _describe_code(fun.__code__),
+        _describe(fun.__defaults__, seen),
+        _describe(fun.__kwdefaults__, seen),
+        _describe(cells, seen),
+    )
+    digest = hashlib.blake2b(":".join(parts).encode(), digest_size=16)
+    return f"{fun.__module__}.{fun.__qualname__}:{digest.hexdigest()}"
+
+
+def _describe(obj, seen=frozenset()):
+    """返回对象的稳定描述. 函数和类用名字表示, 避免repr中包含内存地址.
+
+    其他对象用repr描述, repr中包含内存地址时抛出ValueError.
+
+    seen为正在描述的函数, 避免闭包引用自己时无限递归.
+    """
+
+    if isinstance(obj, (tuple, list)):
+        return type(obj).__name__ + str([_describe(o, seen) for o in obj])
+    if isinstance(obj, dict):
+        return str({k: _describe(v, seen) for k, v in sorted(obj.items())})
+    if isinstance(obj, types.FunctionType) and id(obj) not in seen:
+        return _describe_function(obj, seen)
+    if isinstance(obj, types.MethodType):
+        # 绑定的对象也属于身份, 比如不同的MapStore的get
+        return f"{_describe(obj.__func__, seen)}:" + \
+            _describe(obj.__self__, seen)
+    if isinstance(obj, np.ndarray):
+        digest = hashlib.blake2b(np.ascontiguousarray(obj).data, digest_size=16)
+        return f"ndarray({obj.dtype.str}, {obj.shape}, {digest.hexdigest()})"
+    if callable(obj) and hasattr(obj, "__qualname__"):
+        return f"{obj.__module__}.{obj.__qualname__}"
+    text = repr(obj)
+    if _ADDRESS_PATTERN.search(text):
+        raise ValueError(
+            f"Cannot derive a stable cache key from {text}: define __repr__ "
+            "for it or pass task_key to ResultCache.")
+    return text
+
+
+class ResultCache:
+    """基于内容寻址的结果缓存, 参考模块的说明.
+
+    root (str): 缓存的目录, 不同的task可以共用一个目录.
+    version (str): task实现的版本号, 修改task的实现之后需要更新.
+    max_bytes (int): 缓存的最大字节数, 超出时删除最久没有使用的结果.
+    task_key (str): 若不为None, 则用它代替类, 初始化参数和shared作为task的
+        身份. 比如每个worker的参数只有GPU编号不同时, 可以让所有worker共用缓存,
+        否则每个worker只能命中自己的结果. 参数不能用repr稳定描述时也需要指定.
+    evict_interval (float): 两次evict之间的最短间隔(秒).
+    """
+
+    def __init__(self, root, version="", max_bytes=10 << 30, task_key=None,
+                 evict_interval=60):  # yapf: disable
+        self.root = os.path.expanduser(root)
+        self.version = version
+        self.max_bytes = max_bytes
+        self.task_key = task_key
+        self.evict_interval = evict_interval
+        self.last_evict = None
+
+    def get_task_keys(self, task_class, task_args, shared=None):
+        """返回每个worker的task_key, task_args为每个worker的初始化参数.
+
+        shared可能很大, 所有worker只计算一次.
+        """
+
+        if self.task_key is not None: return [self.task_key] * len(task_args)
+        prefix = f"{self.version}:{_describe(task_class)}:"
+        # 没有shared时和之前版本的key保持一致
+        suffix = "" if shared is None else f":{_describe(shared)}"
+        return [
+            hashlib.blake2b((prefix + _describe(args) + suffix).encode(),
+                            digest_size=16).hexdigest() for args in task_args
+        ]
+
+    def get(self, task_key, sample):
+        """返回(hit, result). 文件不存在或者已经损坏都当作没有命中."""
+
+        path = self._get_path(task_key, sample)
+        try:
+            with open(path, "rb") as srcfile:
+                result = pickle.load(srcfile)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        return True, result
+
+    def put(self, task_key, sample, result):
+        path = self._get_path(task_key, sample)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as dstfile:
+                pickle.dump(result, dstfile, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def evict(self, force=False):
+        """删除最久没有使用的结果, 直到总大小不超过max_bytes.
+
+        距离上一次evict不到evict_interval秒时直接返回, 除非force为True.
+        """
+
+        now = time.monotonic()
+        if not force and self.last_evict is not None and \
+                now - self.last_evict < self.evict_interval:
+            return
+        self.last_evict = now
+        entries, total = [], 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(".pkl"): continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_bytes: return
+        for _, size, path in sorted(entries):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            if total <= self.max_bytes: break
+
+    def _get_path(self, task_key, sample):
+        data = pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return os.path.join(self.root, task_key, key[:2], key + ".pkl")
+
+
+if __name__ == "__main__":
+    pass
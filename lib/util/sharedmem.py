@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""用共享内存在进程之间传递numpy数组.
+
+multiprocessing.Queue在传递numpy数组的时候, 需要先pickle成字节流, 写入管道, 再
+从管道读出来unpickle, 数据至少被拷贝两次. 对于4K图片这样的大数组, 这部分开销
+往往比任务本身还大.
+
+SharedArrayTransport把大数组写入共享内存文件(Linux下位于/dev/shm), 队列中只传递
+一个很小的SharedArrayHandle. 接收方将文件mmap到自己的地址空间, 然后立即删除文
+件, 得到的数组直接是共享内存的视图, 没有额外的拷贝. 数组被释放时, 对应的内存也
+随之释放, 不需要手动管理.
+
+SharedState用于多个进程共享的只读数据(比如很大的查找表). 其中的大数组只在共享
+内存中保存一份, 每个进程映射为只读的数组, 文件在close之前一直存在.
+"""
+
+import os
+import glob
+import mmap
+import uuid
+import tempfile
+
+import numpy as np
+
+__all__ = ("SharedArrayHandle", "SharedArrayTransport", "SharedState")
+
+# 优先使用tmpfs, 没有的话退化为普通的临时文件(依赖page cache)
+_SHM_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SharedArrayHandle:
+    """共享内存中的numpy数组的句柄, 只包含路径和数组的元信息."""
+
+    __slots__ = ("path", "shape", "dtype")
+
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return self.path, self.shape, self.dtype
+
+    def __setstate__(self, state):
+        self.path, self.shape, self.dtype = state
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def attach(self, keep=False):
+        """将共享内存映射为numpy数组, 并删除共享内存文件. 只能调用一次.
+
+        keep为True时不删除文件, 得到只读的数组, 可以多次调用.
+        """
+
+        fd = os.open(self.path, os.O_RDONLY if keep else os.O_RDWR)
+        try:
+            if keep:
+                buffer = mmap.mmap(fd, self.nbytes, access=mmap.ACCESS_READ)
+            else:
+                buffer = mmap.mmap(fd, self.nbytes)
+        finally:
+            os.close(fd)
+            if not keep: os.unlink(self.path)
+        array = np.frombuffer(buffer, dtype=self.dtype)
+        return array.reshape(self.shape)
+
+
+class SharedArrayTransport:
+    """将样本中的大数组替换成共享内存句柄, 以及反向操作.
+
+    encode和decode会递归地处理tuple, list和dict, 其余类型保持不变. 数据量小于
+    threshold的数组仍然通过pickle传递, 因为这时共享内存的固定开销更大.
+    """
+
+    def __init__(self, threshold=1 << 20):
+        assert threshold > 0
+        self.threshold = threshold
+        # 同一个transport创建的文件具有相同的前缀, 方便最后统一清理
+        self.prefix = f"sharedarray-{os.getpid()}-{uuid.uuid4().hex[:8]}-"
+
+    def encode(self, obj):
+        if isinstance(obj, np.ndarray):
+            if obj.nbytes < self.threshold or obj.dtype.hasobject: return obj
+            return self._write_array(obj)
+        if isinstance(obj, tuple):
+            return tuple(self.encode(o) for o in obj)
+        if isinstance(obj, list):
+            return [self.encode(o) for o in obj]
+        if isinstance(obj, dict):
+            return {k: self.encode(v) for k, v in obj.items()}
+        return obj
+
+    def decode(self, obj, keep=False):
+        if isinstance(obj, SharedArrayHandle):
+            return obj.attach(keep)
+        if isinstance(obj, tuple):
+            return tuple(self.decode(o, keep) for o in obj)
+        if isinstance(obj, list):
+            return [self.decode(o, keep) for o in obj]
+        if isinstance(obj, dict):
+            return {k: self.decode(v, keep) for k, v in obj.items()}
+        return obj
+
+    def cleanup(self):
+        """删除还没有被接收方取走的共享内存文件."""
+
+        for path in glob.glob(os.path.join(_SHM_ROOT, self.prefix + "*")):
+            if os.path.exists(path): os.unlink(path)
+
+    def _write_array(self, array):
+        array = np.ascontiguousarray(array)
+        fd, path = tempfile.mkstemp(prefix=self.prefix, dir=_SHM_ROOT)
+        try:
+            os.ftruncate(fd, array.nbytes)
+            with mmap.mmap(fd, array.nbytes) as buffer:
+                buffer[:] = array.reshape(-1).view(np.uint8)
+        finally:
+            os.close(fd)
+        return SharedArrayHandle(path, array.shape, array.dtype)
+
+
+class SharedState:
+    """多个进程共享的只读数据, 参考模块的说明.
+
+    构造时把obj中的大数组写入共享内存, 之后每次load得到一个副本, 其中的数组
+    是共享内存的只读视图, 其余部分通过pickle传递. 不再使用时需要调用close.
+    """
+
+    def __init__(self, obj, threshold=1 << 20):
+        self.transport = SharedArrayTransport(threshold)
+        self.encoded = self.transport.encode(obj)
+
+    def load(self):
+        return self.transport.decode(self.encoded, keep=True)
+
+    def close(self):
+        self.transport.cleanup()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,358 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""通过TCP把map操作分发到多台机器上.
+
+MapTaskBroker在主进程中启动一个multiprocessing.managers的server, 把输入和输出
+队列通过TCP提供出去. 其他机器(或者本机的其他进程)调用serve_map_workers启动
+worker, 每个worker连上broker之后从输入队列中取样本, 处理完之后写回输出队列.
+worker可以在任意时刻加入, 每台机器有自己的task_args, 比如本机的GPU编号.
+broker还没有启动时worker会等待并重试.
+
+worker定期向broker发送心跳. 远程的进程退出或者机器断开之后, 心跳超时, 它正在
+处理的chunk重新发送给其他worker, 重试次数的规则和本地的worker异常退出相同.
+
+broker的接口和MapTaskPool一致(process, imap, imap_unordered等), 分发和排序的
+逻辑也是同一套. 样本和结果通过pickle传输, 所以task类必须在worker所在的机器上
+也能import. 另外共享内存不能跨机器, 这里不支持transport.
+
+manager的协议是pickle, 能够连接到broker的人可以在主进程中执行任意代码, 所以
+authkey是必须的, 并且默认只监听127.0.0.1. 需要跨机器时显式指定监听的地址, 并且
+只在可信的网络中使用.
+
+用法:
+    # 主节点
+    broker = lib.util.MapTaskBroker(("0.0.0.0", 6000), authkey=b"secret")
+    results = broker.process(samples)
+    broker.finish()
+    # 计算节点, 每块GPU一个worker
+    lib.util.serve_map_workers(
+        ("master", 6000), TaskClass, [0, 1, 2, 3], authkey=b"secret")
+"""
+
+import time
+import socket
+import logging
+import threading
+import multiprocessing.connection
+import multiprocessing.managers
+
+import lib.util
+from lib.util.multitask import MapTaskDispatcher
+from lib.util.multitask import MapTaskWorker
+from lib.util.multitask import ProxyMapTaskClass
+
+__all__ = ("MapTaskBroker", "serve_map_workers")
+
+# 远程worker发送心跳的间隔
+_HEARTBEAT_INTERVAL = 1.0
+
+
+class _BrokerState:
+    """记录连接到broker的worker, 为每个worker分配序号.
+
+    worker通过这里取样本和返回结果, 所以broker知道每个worker正在处理哪个
+    chunk. worker停止心跳之后被判定为退出, 它之后取样本和返回结果都会被忽略.
+    """
+
+    def __init__(self, input_queue, output_queue):
+        self.lock = threading.Lock()
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.num_workers = 0
+        self.closed = False
+        # 还活着的worker正在处理的chunk序号(空闲时为None)和最近一次心跳的时间
+        self.chunks = {}
+        self.last_seen = {}
+
+    def register(self):
+        """返回新worker的序号. broker已经关闭时返回None."""
+
+        with self.lock:
+            if self.closed: return None
+            worker_id = self.num_workers
+            self.num_workers += 1
+            self.chunks[worker_id] = None
+            self.last_seen[worker_id] = time.monotonic()
+            return worker_id
+
+    def get_chunk(self, worker_id):
+        """取下一个chunk, 返回None时worker退出."""
+
+        item = self.input_queue.get()
+        with self.lock:
+            if worker_id in self.chunks:
+                if item is None:
+                    del self.chunks[worker_id]
+                    del self.last_seen[worker_id]
+                else:
+                    _, (chunk_id, _) = item
+                    self.chunks[worker_id] = chunk_id
+                return item
+        # worker已经被判定为退出, 取到的chunk留给其他worker
+        self.input_queue.put(item)
+        return None
+
+    def put_result(self, worker_id, message):
+        with self.lock:
+            # 被判定为退出的worker的chunk已经重新发送过了
+            if worker_id not in self.chunks: return
+            self.chunks[worker_id] = None
+            self.output_queue.put(message)
+
+    def heartbeat(self, worker_id):
+        """更新心跳的时间. 返回False表示worker已经被判定为退出."""
+
+        with self.lock:
+            if worker_id not in self.chunks: return False
+            self.last_seen[worker_id] = time.monotonic()
+            return True
+
+    def pop_dead(self, timeout):
+        """超过timeout秒没有心跳的worker判定为退出, 返回{worker_id: chunk_id}.
+
+        chunk_id为worker正在处理的chunk, 空闲时为None.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            dead = [
+                worker_id for worker_id, last_seen in self.last_seen.items()
+                if now - last_seen > timeout
+            ]
+            for worker_id in dead:
+                del self.last_seen[worker_id]
+            return {worker_id: self.chunks.pop(worker_id) for worker_id in dead}
+
+    def close(self):
+        """关闭broker, 返回还活着的worker个数."""
+
+        with self.lock:
+            self.closed = True
+            return len(self.chunks)
+
+    def get_num_workers(self):
+        return len(self.chunks)
+
+
+class _BrokerClient(multiprocessing.managers.BaseManager):
+    """worker端的manager, 只需要知道接口的名字."""
+
+
+_BrokerClient.register("get_state")
+
+
+class _RemoteQueue:
+    """MapTaskWorker的输入和输出队列, 通过broker的_BrokerState取样本和返回
+    结果."""
+
+    def __init__(self, state, worker_id):
+        self.state = state
+        self.worker_id = worker_id
+
+    def get(self):
+        return self.state.get_chunk(self.worker_id)
+
+    def put(self, message):
+        self.state.put_result(self.worker_id, message)
+
+
+class MapTaskBroker(MapTaskDispatcher):
+    """通过TCP分发样本的MapTaskPool, worker由serve_map_workers启动.
+
+    address (tuple): 监听的地址, 端口为0时自动选择, 实际的地址为self.address.
+        默认只接受本机的连接.
+    authkey (bytes): worker连接时使用的密钥, 必须指定.
+    num_workers (int): 预计的worker数, 只在还没有worker连接时用于决定chunk大小.
+    max_retries (int), on_error (str): 同MapTaskPool.get_pool. worker停止
+        心跳时, 它正在处理的chunk和本地worker异常退出时一样重新发送.
+    heartbeat_timeout (float): 超过这么多秒没有收到心跳的worker被判定为退出.
+        task持有GIL的时间很长时需要调大.
+    """
+
+    def __init__(self, address=("127.0.0.1", 0), authkey=None,
+                 task_name="remote", num_workers=1, max_retries=0,
+                 on_error="raise", heartbeat_timeout=10.0):  # yapf: disable
+        assert authkey, "MapTaskBroker requires an explicit authkey."
+        assert heartbeat_timeout > _HEARTBEAT_INTERVAL
+        # 不创建本地的worker, 只使用分发样本和收集结果的部分
+        super().__init__(
+            task_name, "remote", 0, max_retries=max_retries,
+            on_error=on_error)
+        self.expected_workers = num_workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.state = _BrokerState(self.input_queue, self.output_queue)
+
+        # 队列保存在主进程中, 本地直接访问, 不经过manager
+        manager_class = type(
+            "_BrokerServer", (multiprocessing.managers.BaseManager, ), {})
+        manager_class.register("get_state", lambda: self.state)
+        self.server = manager_class(("127.0.0.1", 0), authkey).get_server()
+        self.server.stop_event = threading.Event()
+        # 监听的socket由这里创建, 这样finish时可以关闭它. manager自己的
+        # listener不使用, 直接关闭
+        self.server.listener.close()
+        self.socket = socket.create_server(address, backlog=16)
+        self.address = self.socket.getsockname()[:2]
+        self.closing = False
+        self.thread = threading.Thread(target=self._serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def num_workers(self):
+        return max(self.state.get_num_workers(), self.expected_workers, 1)
+
+    def _serve_forever(self):
+        """代替Server.serve_forever接受连接. 每个连接由一个线程处理, 和
+        Server.accepter一样, 认证在Server.handle_request中进行.
+        """
+
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                if self.closing: break
+                continue
+            connection = multiprocessing.connection.Connection(client.detach())
+            # finish之后仍然处理已经建立的连接, worker退出时需要通知broker
+            thread = threading.Thread(
+                target=self._handle_request, args=(connection, ))
+            thread.daemon = True
+            thread.start()
+        self.socket.close()
+
+    def _handle_request(self, connection):
+        try:
+            self.server.handle_request(connection)
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            pass
+
+    def _check_workers(self, call):
+        crashed = {}
+        for worker_id, chunk_id in self.state.pop_dead(
+                self.heartbeat_timeout).items():
+            reason = (f"Remote worker {worker_id} of {self.task_name} "
+                      f"stopped sending heartbeats")
+            logging.warning("%s, requeueing its samples.", reason)
+            if chunk_id is not None: crashed[chunk_id] = reason
+        if not crashed: return None
+        failed = call.recover(crashed, False)
+        if not failed: return None
+        return None, failed, [0.0] * len(failed), None
+
+    def finish(self):
+        # 已经连接的worker收到None之后退出, 之后连接的worker直接退出
+        assert self.input_queue.empty()
+        assert self.output_queue.empty()
+        for _ in range(self.state.close()):
+            self.input_queue.put(None)
+        # shutdown之后阻塞在accept中的线程马上返回, 由它关闭监听的socket. fork
+        # 出来的子进程继承了这个socket, 只close的话端口仍然在监听
+        self.closing = True
+        self.socket.shutdown(socket.SHUT_RDWR)
+        self.thread.join()
+
+    async def afinish(self):
+        self.finish()
+
+
+class RemoteMapTaskProcess(multiprocessing.Process):
+    """连接到broker的worker进程, 对应MapTaskProcess.
+
+    broker还没有启动时每隔一段时间重试, 间隔从0.1秒开始加倍, 最长5秒. 超过
+    connect_timeout秒仍然连接不上时抛出ConnectionError.
+    """
+
+    def __init__(self, address, authkey, task_class, task_args, limits=None,
+                 connect_timeout=60.0):  # yapf: disable
+        super().__init__()
+        self.address = address
+        self.authkey = authkey
+        self.task_class = task_class
+        self.task_args = task_args
+        self.limits = limits
+        self.connect_timeout = connect_timeout
+
+    def _connect(self):
+        client = _BrokerClient(self.address, self.authkey)
+        deadline = time.monotonic() + self.connect_timeout
+        delay = 0.1
+        while True:
+            try:
+                client.connect()
+                return client
+            except ConnectionError:
+                if time.monotonic() + delay > deadline: raise
+            time.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+    def run(self):
+        # pylint: disable=no-member
+        state = self._connect().get_state()
+        worker_id = state.register()
+        # broker已经结束, 不再接受新的worker
+        if worker_id is None: return
+        thread = threading.Thread(
+            target=_send_heartbeats, args=(state, worker_id))
+        thread.daemon = True
+        thread.start()
+        remote_queue = _RemoteQueue(state, worker_id)
+        worker = MapTaskWorker(
+            self.task_class,
+            self.task_args,
+            remote_queue,
+            remote_queue,
+            None,
+            worker_id,
+            limits=self.limits,
+        )
+        try:
+            worker.run()
+        except (EOFError, ConnectionError):
+            # broker所在的进程已经退出
+            pass
+
+
+def _send_heartbeats(state, worker_id):
+    # 代理对象在每个线程中使用单独的连接, 不会和取样本的调用互相阻塞
+    try:
+        while state.heartbeat(worker_id):
+            time.sleep(_HEARTBEAT_INTERVAL)
+    except (EOFError, ConnectionError):
+        pass
+
+
+def serve_map_workers(address, task_class_or_fun, task_args, authkey=None,
+                      placement=None, connect_timeout=60.0):  # yapf: disable
+    """在当前机器上启动len(task_args)个worker, 直到broker结束.
+
+    task_class_or_fun (class or function): 同MapTaskPool.get_pool. 为函数时,
+        task_args中的每一项为函数的额外参数.
+    task_args (list): 每个worker的初始化参数, 参考MapTaskPool.
+    authkey (bytes): 和MapTaskBroker相同的密钥, 必须指定.
+    placement (WorkerPlacement): 本机worker的CPU绑定和原生线程数, 参考
+        MapTaskPool.get_pool.
+    connect_timeout (float): 等待broker启动的最长时间, 参考RemoteMapTaskProcess.
+    """
+
+    assert authkey, "serve_map_workers requires an explicit authkey."
+    task_class = task_class_or_fun
+    if not hasattr(task_class_or_fun, "process"):
+        task_class = ProxyMapTaskClass
+        task_args = [(task_class_or_fun, args) for args in task_args]
+    placement = placement or lib.util.WorkerPlacement()
+    limits = placement.get_limits(len(task_args))
+    processes = [
+        RemoteMapTaskProcess(
+            address, authkey, task_class, args, limit, connect_timeout)
+        for args, limit in zip(task_args, limits)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,604 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""map和reduce操作共用的部分: 异常, worker中调用task的方式, 以及一次调用的
+分发状态.
+
+TaskCall记录一次process或者accumulate调用中已经发送, 处理完和取走的样本数,
+由ChunkSizer决定每个chunk的大小. NotifyQueue和watch_queue让asyncio的event
+loop直接等待worker的结果, 不占用额外的线程. 除了TaskError之外, 这些都是
+lib.util.multitask, lib.util.taskreduce和lib.util.taskbroker内部使用的,
+不从lib.util导出.
+"""
+
+import time
+import queue
+import ctypes
+import pickle
+import asyncio
+import itertools
+import traceback
+import collections
+import multiprocessing
+
+import lib.util
+
+__all__ = ("TaskError", )
+
+# 等待worker返回消息时, 每隔这么长时间检查一次worker是否还活着
+HEALTH_CHECK_INTERVAL = 1.0
+# 推测执行时估计处理时间至少需要的样本数
+SPECULATE_MIN_SAMPLES = 5
+# 按照目录创建的ResultCache, 参考get_cache
+_CACHES = {}
+
+
+class TaskError(Exception):
+    """样本处理失败. index为样本在输入中的序号, details为worker中的调用栈."""
+
+    def __init__(self, message, details="", index=None):
+        super().__init__(message)
+        self.message = message
+        self.details = details
+        self.index = index
+
+    def __reduce__(self):
+        return TaskError, (self.message, self.details, self.index)
+
+    def __str__(self):
+        text = f"Sample {self.index}: {self.message}"
+        return f"{text}\n{self.details}" if self.details else text
+
+    @staticmethod
+    def from_exception(error):
+        message = f"{type(error).__name__}: {error}"
+        task_error = TaskError(message, traceback.format_exc())
+        # 跨进程传递时__reduce__不包含__cause__, 只在同一个进程中保留
+        task_error.__cause__ = error
+        return task_error
+
+
+def raise_inline(error):
+    """inline版本中抛出task原来的异常, 和没有TaskError之前的行为保持一致."""
+
+    if error.__cause__ is None: raise error
+    raise error.__cause__
+
+
+def get_transport(transport):
+    """transport可以为None, "shm"或者SharedArrayTransport实例."""
+
+    if transport is None: return None
+    if isinstance(transport, lib.util.SharedArrayTransport): return transport
+    assert transport == "shm", f"Unknown transport: {transport}"
+    return lib.util.SharedArrayTransport()
+
+
+def encode(transport, obj):
+    return transport.encode(obj) if transport else obj
+
+
+def decode(transport, obj):
+    return transport.decode(obj) if transport else obj
+
+
+def get_on_error(on_error):
+    assert on_error in ("raise", "return"), f"Unknown on_error: {on_error}"
+    return on_error
+
+
+def create_slot(backend):
+    """worker记录当前正在处理的chunk和开始处理的时间, 主进程可以直接读取.
+
+    用于worker异常退出之后找到出错的chunk, 以及推测执行时找到运行太久的chunk.
+    """
+
+    if backend == "process":
+        return multiprocessing.RawArray(ctypes.c_double, [-1, 0])
+    return (ctypes.c_double * 2)(-1, 0)
+
+
+def get_backend(backend, num_workers):
+    if backend is None: return "inline" if num_workers == 1 else "process"
+    assert backend in ("process", "thread", "inline"), \
+        f"Unknown backend: {backend}"
+    return backend
+
+
+def create_task(task_class, task_args, shared=None):
+    kwargs = {} if shared is None else {"shared": shared}
+    if isinstance(task_args, tuple):
+        return task_class(*task_args, **kwargs)
+    return task_class(task_args, **kwargs)
+
+
+def share_state(shared, backend):
+    """返回传给worker的shared. 只有spawn等方式启动的进程需要共享内存."""
+
+    if shared is None or backend != "process": return shared
+    if multiprocessing.get_start_method() == "fork": return shared
+    return lib.util.SharedState(shared)
+
+
+def get_limits(placement, backend, num_workers):
+    """返回每个worker的(cpus, threads). 这些都是进程级别的设置, 只用于进程版本.
+
+    placement为None时使用默认的WorkerPlacement, 即只限制线程数.
+    """
+
+    if backend != "process": return [None] * num_workers
+    placement = placement or lib.util.WorkerPlacement()
+    return placement.get_limits(num_workers)
+
+
+def load_state(shared):
+    if isinstance(shared, lib.util.SharedState): return shared.load()
+    return shared
+
+
+def close_state(shared):
+    if isinstance(shared, lib.util.SharedState): shared.close()
+
+
+def call_process(task, sample):
+    if isinstance(sample, tuple):
+        return task.process(*sample)
+    return task.process(sample)
+
+
+def get_cache(cache):
+    """cache可以为None, 缓存目录或者ResultCache实例.
+
+    同一个目录使用同一个实例, 这样多次map之间evict_interval仍然有效.
+    """
+
+    if cache is None or isinstance(cache, lib.util.ResultCache): return cache
+    if cache not in _CACHES: _CACHES[cache] = lib.util.ResultCache(cache)
+    return _CACHES[cache]
+
+
+def call_cached(task, sample, cache, task_key):
+    """先查询缓存, 没有命中时调用process并写入缓存. 返回(hit, result)."""
+
+    if cache is None: return False, call_process(task, sample)
+    hit, result = cache.get(task_key, sample)
+    if not hit:
+        result = call_process(task, sample)
+        cache.put(task_key, sample, result)
+    return hit, result
+
+
+def retry(function, max_retries):
+    """调用function(), 出错时重试. 最终失败时返回TaskError, 而不是抛出异常."""
+
+    for attempt in range(max_retries + 1):
+        try:
+            return function()
+        except Exception as error:  # pylint: disable=broad-except
+            if attempt == max_retries: return TaskError.from_exception(error)
+    return None
+
+
+def call_with_retry(task, sample, cache, task_key, max_retries):
+    output = retry(
+        lambda: call_cached(task, sample, cache, task_key), max_retries)
+    if isinstance(output, TaskError): return False, output
+    return output
+
+
+def get_length(samples):
+    """返回样本个数, 若samples为generator, 则返回None."""
+
+    return len(samples) if hasattr(samples, "__len__") else None
+
+
+def estimate_size(sample):
+    """估计样本pickle之后的字节数. 常见类型直接计算, 其余类型用pickle测量."""
+
+    if hasattr(sample, "nbytes"): return sample.nbytes
+    if isinstance(sample, (bytes, str)): return len(sample)
+    if isinstance(sample, (tuple, list)):
+        return sum(estimate_size(s) for s in sample)
+    return len(pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def should_measure(num_chunks):
+    """测量数据量本身有开销(可能需要pickle), 前几个chunk之后只是偶尔测量."""
+
+    return num_chunks <= 4 or num_chunks % 16 == 0
+
+
+class ChunkSizer:
+    """根据实测数据自适应地决定每个chunk包含多少个样本.
+
+    chunk越大, 队列和pickle的固定开销摊得越薄, 但是负载越不均衡. 这里让一个
+    chunk的处理时间接近target_time, 数据量不超过max_bytes. 在样本数已知时, 保证
+    每个进程至少能分到4个chunk. 刚开始没有测量数据, chunk大小为1.
+    """
+
+    def __init__(self, num_workers, num_samples=None, max_pending=None,
+                 chunksize=None, target_time=0.02, max_bytes=4 << 20,
+                 max_chunksize=1024):  # yapf: disable
+        self.num_workers = num_workers
+        self.fixed_chunksize = chunksize
+        self.fixed_max_pending = max_pending
+        self.target_time = target_time
+        self.max_bytes = max_bytes
+
+        self.limit = max_chunksize
+        if num_samples:
+            self.limit = min(self.limit, num_samples // (4 * num_workers))
+        if max_pending:
+            self.limit = min(self.limit, max_pending // (2 * num_workers))
+        self.limit = max(self.limit, 1)
+
+        # 单个样本的处理时间(秒)和数据量(字节), 指数滑动平均
+        self.task_time = None
+        self.sample_bytes = None
+        self.num_chunks = 0
+
+    @property
+    def chunksize(self):
+        if self.fixed_chunksize: return self.fixed_chunksize
+        if self.task_time is None: return 1
+        size = self.target_time / max(self.task_time, 1e-7)
+        if self.sample_bytes:
+            size = min(size, self.max_bytes / max(self.sample_bytes, 1))
+        return int(max(1, min(size, self.limit)))
+
+    @property
+    def max_pending(self):
+        if self.fixed_max_pending: return self.fixed_max_pending
+        return 4 * self.num_workers * self.chunksize
+
+    def probe(self, sample):
+        """测量样本的数据量. 测量本身有开销, 前几个chunk之后只是偶尔测量."""
+
+        self.num_chunks += 1
+        if self.fixed_chunksize: return
+        if not should_measure(self.num_chunks): return
+        nbytes = estimate_size(sample)
+        if self.sample_bytes is None:
+            self.sample_bytes = nbytes
+        else:
+            self.sample_bytes = 0.8 * self.sample_bytes + 0.2 * nbytes
+
+    def update(self, num_samples, elapsed):
+        """子进程处理完一个chunk之后, 更新单个样本的处理时间."""
+
+        task_time = elapsed / max(num_samples, 1)
+        if self.task_time is None:
+            self.task_time = task_time
+        else:
+            self.task_time = 0.8 * self.task_time + 0.2 * task_time
+
+
+class NotifyQueue(queue.Queue):
+    """线程版本的队列. put之后调用callback, 用于唤醒asyncio的event loop."""
+
+    def __init__(self):
+        super().__init__()
+        self.callback = None
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        callback = self.callback
+        if callback: callback()
+
+
+def create_queue(backend):
+    if backend == "process": return multiprocessing.Queue()
+    return NotifyQueue()
+
+
+def watch_queue(output_queue, messages=None):
+    """将output_queue中的消息转发到一个asyncio.Queue中, 不占用额外的线程.
+
+    进程版本在event loop中监听队列底层管道的文件描述符, 线程版本在put的时候
+    通知event loop. 返回asyncio.Queue和一个取消监听的函数. messages不为None
+    时转发到已有的asyncio.Queue中.
+    """
+
+    loop = asyncio.get_running_loop()
+    messages = asyncio.Queue() if messages is None else messages
+
+    def pump():
+        while True:
+            try:
+                messages.put_nowait(output_queue.get_nowait())
+            except queue.Empty:
+                return
+
+    if isinstance(output_queue, NotifyQueue):
+        output_queue.callback = lambda: loop.call_soon_threadsafe(pump)
+        pump()
+        return messages, lambda: setattr(output_queue, "callback", None)
+    # multiprocessing.Queue没有公开底层的管道, 这里只能用私有成员
+    fd = output_queue._reader.fileno()  # pylint: disable=protected-access
+    loop.add_reader(fd, pump)
+    return messages, lambda: loop.remove_reader(fd)
+
+
+async def ajoin(workers):
+    """等待所有worker退出. 进程通过sentinel监听, 不阻塞event loop."""
+
+    loop = asyncio.get_running_loop()
+    for worker in workers:
+        if isinstance(worker, multiprocessing.Process):
+            exited = loop.create_future()
+            loop.add_reader(
+                worker.sentinel,
+                lambda f=exited: f.done() or f.set_result(None),
+            )
+            try:
+                await exited
+            finally:
+                loop.remove_reader(worker.sentinel)
+        # 线程收到退出信号之后马上退出, 这里的join不会阻塞太久
+        worker.join()
+
+
+class TaskCall:
+    """一次process或者accumulate调用中的分发状态, 同步和异步接口共用.
+
+    num_sent为已经送入队列的样本数, num_done为worker已经处理完的样本数,
+    num_consumed为调用者已经取走的样本数. 送出但还没有被取走的样本数不超过
+    max_pending. 子类实现receive, 处理worker返回的消息.
+    """
+
+    def __init__(self, pool, samples, max_pending, chunksize):
+        assert max_pending is None or max_pending > 0
+        num_workers = pool.num_workers
+        self.input_queue = pool.input_queue
+        self.sizer = ChunkSizer(
+            num_workers,
+            get_length(samples),
+            max_pending,
+            chunksize,
+        )
+        self.tracker = lib.util.get_progress_tracker(
+            total=get_length(samples))
+        head = f"Task {pool.task_name} ({pool.backend} {num_workers})"
+        self.tracker.set_description(head)
+        self.metrics = pool.metrics
+        self.num_sent, self.num_done, self.num_consumed = 0, 0, 0
+        self.exhausted = False
+
+    @property
+    def pending(self):
+        return self.num_sent - self.num_done
+
+    @property
+    def finished(self):
+        return self.exhausted and self.pending == 0
+
+    def wants_more(self):
+        if self.exhausted: return False
+        return self.num_sent - self.num_consumed < self.sizer.max_pending
+
+    def feed(self, samples):
+        """从迭代器中读取样本并送入队列, 直到达到max_pending或者样本读完."""
+
+        while self.wants_more():
+            size = self.sizer.chunksize
+            self._send(list(itertools.islice(samples, size)), size)
+
+    async def afeed(self, samples):
+        """同feed, 但samples也可以是async iterator."""
+
+        if not hasattr(samples, "__anext__"):
+            self.feed(samples)
+            return
+        while self.wants_more():
+            size, chunk = self.sizer.chunksize, []
+            while len(chunk) < size:
+                try:
+                    chunk.append(await anext(samples))
+                except StopAsyncIteration:
+                    break
+            self._send(chunk, size)
+
+    def close(self):
+        self.tracker.close()
+
+    def _send(self, chunk, size):
+        if len(chunk) < size: self.exhausted = True
+        if not chunk: return
+        self.sizer.probe(chunk[0])
+        self._put(self._pack(chunk))
+        self.num_sent += len(chunk)
+
+    def _pack(self, chunk):
+        return chunk
+
+    def _put(self, chunk):
+        # 附带发送时间, 用于统计样本在队列中的等待时间
+        self.input_queue.put((time.time(), chunk))
+
+
+def iter_samples(samples):
+    """返回同步或者异步的迭代器."""
+
+    if hasattr(samples, "__aiter__"): return aiter(samples)
+    return iter(samples)
+
+
+class MapCall(TaskCall):
+    """一次imap调用的状态. 有序模式下, 取回但还没有输出的结果暂存在buffer中.
+
+    raw为True时不排序, 输出(sid, result, duration), 供调用者自己处理.
+    """
+
+    def __init__(self, pool, samples, ordered, max_pending, chunksize,
+                 raw=False):  # yapf: disable
+        super().__init__(pool, samples, max_pending, chunksize)
+        self.ordered = ordered and not raw
+        self.raw = raw
+        self.transport = pool.transport
+        self.buffer = {}
+        # 已经发送但是还没有返回的chunk, 用于worker异常退出时重新发送
+        self.chunk_ids = pool.chunk_ids
+        self.inflight = {}
+        self.attempts = {}
+        self.max_retries = pool.max_retries
+        self.on_error = pool.on_error
+        # 异步调用中监听output_queue的asyncio.Queue和取消监听的函数
+        self.messages, self.unwatch = None, None
+        # 推测执行: groups为同一个chunk的各份的序号, late为之后还会返回的落后
+        # 的结果数, recent为最近的样本处理时间
+        self.groups = {}
+        self.late = 0
+        self.recent = collections.deque(maxlen=1000)
+
+    def receive(self, message):
+        """处理worker返回的一个chunk, 返回可以输出给调用者的结果."""
+
+        chunk_id, results, durations, metrics = message
+        # chunk_id为None表示worker异常退出导致的失败. 找不到chunk_id说明这是
+        # 推测执行中落后的一份, 这里直接丢弃.
+        if chunk_id is not None:
+            if self.inflight.pop(chunk_id, None) is None:
+                self.late -= 1
+                return []
+            for other in self.groups.pop(chunk_id, ()):
+                self.groups.pop(other, None)
+                if self.inflight.pop(other, None) is not None: self.late += 1
+            self.metrics.update(metrics)
+            self.sizer.update(len(results), sum(durations))
+            self.recent.extend(durations)
+        self.num_done += len(results)
+        self.tracker.update(len(results))
+        start = time.perf_counter()
+        results = [(sid, decode(self.transport, r)) for sid, r in results]
+        self.metrics.serialize_time += time.perf_counter() - start
+        for sid, result in results:
+            if isinstance(result, TaskError): result.index = sid
+        if self.raw:
+            self.num_consumed += len(results)
+            return [(sid, r, d) for (sid, r), d in zip(results, durations)]
+        if not self.ordered:
+            self.num_consumed += len(results)
+            return [r for _, r in results]
+        self.buffer.update(results)
+        outputs = []
+        while self.num_consumed in self.buffer:
+            outputs.append(self.buffer.pop(self.num_consumed))
+            self.num_consumed += 1
+        return outputs
+
+    def check(self, outputs):
+        """on_error为"raise"时, 遇到处理失败的样本抛出TaskError."""
+
+        # raw模式下样本的序号由调用者转换, 也由调用者处理
+        if self.on_error == "raise" and not self.raw:
+            for output in outputs:
+                if isinstance(output, TaskError): raise output
+        return outputs
+
+    def recover(self, crashed, requeue_all):
+        """worker异常退出之后, 重新发送还没有返回的chunk, 返回失败的样本.
+
+        crashed为退出的worker正在处理的chunk序号到退出原因的映射. 不知道是哪个
+        样本导致的退出, 所以这些chunk中的样本被逐个重新发送. 只有单独发送的
+        样本才计入重试次数, 超过max_retries的样本直接失败. requeue_all为True
+        时队列已经被替换, 其余没有返回的chunk也全部重新发送. 原来的结果如果
+        之后到达, 会在receive中被丢弃.
+        """
+
+        self._merge_copies(crashed, requeue_all)
+        failed = []
+        for chunk_id in sorted(self.inflight):
+            if chunk_id not in crashed:
+                if requeue_all:
+                    self._put(self._pack_items(self.inflight.pop(chunk_id)))
+                continue
+            chunk = self.inflight.pop(chunk_id)
+            for sid, sample in chunk:
+                if len(chunk) == 1:
+                    self.attempts[sid] = self.attempts.get(sid, 0) + 1
+                    if self.attempts[sid] > self.max_retries:
+                        failed.append((sid, TaskError(crashed[chunk_id])))
+                        continue
+                self._put(self._pack_items([(sid, sample)]))
+        return failed
+
+    def get_expected_duration(self):
+        """最近处理完的样本的处理时间的中位数, 样本太少时返回None."""
+
+        if len(self.recent) < SPECULATE_MIN_SAMPLES: return None
+        return sorted(self.recent)[len(self.recent) // 2]
+
+    def duplicate(self, chunk_id):
+        """推测执行: 再发送一份chunk, 先返回的一份有效, 另一份被丢弃."""
+
+        copy_id, chunk = self._pack_items(self.inflight[chunk_id])
+        group = self.groups.setdefault(chunk_id, [chunk_id])
+        group.append(copy_id)
+        self.groups[copy_id] = group
+        self._put((copy_id, chunk))
+
+    def _merge_copies(self, crashed, requeue_all):
+        """worker异常退出之后, 同一个chunk的各份只保留一份, 优先保留没有出错的.
+
+        队列没有被替换时, 被丢掉的副本如果还在运行, 之后仍然会返回结果.
+        """
+
+        for group in {id(g): g for g in self.groups.values()}.values():
+            alive = [i for i in group if i in self.inflight]
+            keep = [i for i in alive if i not in crashed][:1] or alive[:1]
+            for chunk_id in alive:
+                if chunk_id in keep: continue
+                self.inflight.pop(chunk_id)
+                if chunk_id not in crashed and not requeue_all: self.late += 1
+        self.groups.clear()
+
+    def _pack(self, chunk):
+        # 这里加上样本序号, 因为要对结果排序
+        return self._pack_items(list(enumerate(chunk, self.num_sent)))
+
+    def _pack_items(self, items):
+        chunk_id = next(self.chunk_ids)
+        self.inflight[chunk_id] = items
+        start = time.perf_counter()
+        chunk = [(sid, encode(self.transport, sample))
+                 for sid, sample in items]
+        self.metrics.serialize_time += time.perf_counter() - start
+        return chunk_id, chunk
+
+
+class ReduceCall(TaskCall):
+    """一次accumulate调用的状态. worker处理完样本之后就算被取走了."""
+
+    def __init__(self, pool, samples, max_pending, chunksize):
+        super().__init__(pool, samples, max_pending, chunksize)
+        self.errors = []
+
+    def receive(self, message):
+        _, num_samples, elapsed, metrics, errors = message
+        self.errors.extend(errors)
+        self.metrics.update(metrics)
+        self.num_done += num_samples
+        self.num_consumed += num_samples
+        self.sizer.update(num_samples, elapsed)
+        self.tracker.update(num_samples)
+
+
+class KeyedReduceCall(ReduceCall):
+    """按照key将样本分发给固定的worker, 每个worker处理的key互不相交."""
+
+    def __init__(self, pool, samples, max_pending, chunksize):
+        super().__init__(pool, samples, max_pending, chunksize)
+        self.key = pool.key
+        self.input_queues = pool.input_queues
+
+    def _put(self, chunk):
+        parts = [[] for _ in self.input_queues]
+        for sample in chunk:
+            parts[hash(self.key(sample)) % len(parts)].append(sample)
+        sent_time = time.time()
+        for part, input_queue in zip(parts, self.input_queues):
+            if part: input_queue.put((sent_time, part))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""TaskPool的运行时统计数据.
+
+每个worker维护一个WorkerMetrics, 随处理结果一起发回主进程, 主进程汇总成
+PoolMetrics. 通过这些数据可以判断任务的瓶颈在哪里:
+    * utilization接近1: 计算是瓶颈, 增加worker数才有用.
+    * queue_wait较大: 样本在队列中等待worker, worker不够用.
+    * idle_time较大: worker在等待样本, 上游(读取样本或者主进程)是瓶颈.
+    * serialize_time或者bytes较大: 进程间通信是瓶颈, 可以考虑transport="shm".
+
+所有时间的单位都是秒. serialize_time只包含transport的编码解码时间, 队列内部的
+pickle开销包含在queue_wait和idle_time中. bytes为估计值: 偶尔测量chunk中第一
+个样本的大小, 乘以样本数, 参考taskcall.estimate_size.
+"""
+
+import time
+
+import lib.util
+
+__all__ = ("WorkerMetrics", "PoolMetrics")
+
+
+class WorkerMetrics:
+    """单个worker的统计数据, 所有字段都是从worker启动开始的累计值."""
+
+    FIELDS = ("samples", "chunks", "task_time", "queue_wait",
+              "serialize_time", "bytes_in", "bytes_out", "idle_time",
+              "wall_time", "cache_hits")  # yapf: disable
+
+    def __init__(self, worker_id=0):
+        self.worker_id = worker_id
+        # 字段和FIELDS一一对应, FIELDS决定输出的顺序
+        self.samples = 0
+        self.chunks = 0
+        self.task_time = 0.0
+        self.queue_wait = 0.0
+        self.serialize_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.idle_time = 0.0
+        self.wall_time = 0.0
+        self.cache_hits = 0
+        self.start_time = time.perf_counter()
+
+    @property
+    def utilization(self):
+        """处理样本的时间占worker运行时间的比例."""
+
+        return self.task_time / self.wall_time if self.wall_time else 0.0
+
+    def tick(self):
+        self.wall_time = time.perf_counter() - self.start_time
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        data.update(worker_id=self.worker_id, utilization=self.utilization)
+        return data
+
+
+class PoolMetrics:
+    """一个pool的统计数据, workers为每个worker最新的WorkerMetrics.
+
+    serialize_time为主进程中transport的编码解码时间, 不包含worker中的部分.
+    speculated为推测执行时重复发送的chunk数. retired为异常退出之后被重启的
+    worker在重启之前的累计值, summary中包含这部分.
+    """
+
+    def __init__(self, task_name, backend, num_workers):
+        self.task_name = task_name
+        self.backend = backend
+        self.workers = [WorkerMetrics(i) for i in range(num_workers)]
+        self.retired = WorkerMetrics(-1)
+        self.serialize_time = 0.0
+        self.speculated = 0
+
+    def update(self, metrics):
+        """用worker发回的累计数据替换原来的数据."""
+
+        # 远程worker的个数事先不知道, 这里按需增加
+        while metrics.worker_id >= len(self.workers):
+            self.workers.append(WorkerMetrics(len(self.workers)))
+        self.workers[metrics.worker_id] = metrics
+
+    def retire(self, worker_id):
+        """worker重启之前调用, 把它的累计值并入retired, 然后从0开始计数."""
+
+        metrics = self.workers[worker_id]
+        for field in WorkerMetrics.FIELDS:
+            value = getattr(self.retired, field) + getattr(metrics, field)
+            setattr(self.retired, field, value)
+        self.retired.wall_time = max(self.retired.wall_time, metrics.wall_time)
+        self.workers[worker_id] = WorkerMetrics(worker_id)
+
+    def summary(self):
+        """所有worker的汇总, utilization为各个worker的平均值."""
+
+        data = {}
+        for field in WorkerMetrics.FIELDS:
+            data[field] = sum(getattr(w, field) for w in self.workers)
+            data[field] += getattr(self.retired, field)
+        data["serialize_time"] += self.serialize_time
+        data["wall_time"] = max(
+            (w.wall_time for w in self.workers + [self.retired]), default=0)
+        utilization = sum(w.utilization for w in self.workers)
+        data["utilization"] = utilization / max(len(self.workers), 1)
+        data["speculated"] = self.speculated
+        return data
+
+    def to_dict(self):
+        return {
+            "task_name": self.task_name,
+            "backend": self.backend,
+            "summary": self.summary(),
+            "workers": [w.to_dict() for w in self.workers],
+            "retired": self.retired.to_dict(),
+        }
+
+    def dump_json(self, path):
+        lib.util.write_json_file(self.to_dict(), path)
+
+    def dump_prometheus(self, path, prefix="taskpool"):
+        """写成Prometheus node_exporter的textfile格式.
+
+        open_file先写临时文件再重命名, node_exporter不会读到写了一半的文件.
+        """
+
+        lines = []
+        for field in WorkerMetrics.FIELDS + ("utilization", ):
+            name = f"{prefix}_{field}"
+            kind = "gauge" if field == "utilization" else "counter"
+            lines.append(f"# TYPE {name} {kind}")
+            for worker in self.workers:
+                labels = (f'task="{self.task_name}",'
+                          f'backend="{self.backend}",'
+                          f'worker="{worker.worker_id}"')
+                value = getattr(worker, field)
+                lines.append(f"{name}{{{labels}}} {value}")
+        # textfile格式要求UTF-8, 不依赖locale
+        with lib.util.open_file(path, "wb") as dstfile:
+            dstfile.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""将多个MapTaskPool串联起来的流水线.
+
+各个stage同时运行, stage之间通过有界队列连接, 下游处理不过来时上游自动停下来.
+总耗时接近最慢的stage, 而不是各个stage的耗时之和. 某个stage出错时所有stage
+停止, 调用者收到这个异常.
+
+用法:
+    with lib.util.Pipeline([(4, decode), (8, transform), (2, encode)]) as p:
+        for result in p.imap(samples): ...
+"""
+
+import queue
+import threading
+
+import lib.util
+
+__all__ = ("Pipeline", )
+
+
+class _PipelineStopped(Exception):
+    """流水线中的某个stage出错或者调用者提前退出."""
+
+
+def _put_until(output, item, stop):
+    """同queue.put, 但是在stop被设置时抛出_PipelineStopped."""
+
+    while True:
+        if stop.is_set(): raise _PipelineStopped()
+        try:
+            output.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _iter_stage(input_queue, stop):
+    """从stage之间的队列中读取样本, 遇到None时结束."""
+
+    while True:
+        if stop.is_set(): raise _PipelineStopped()
+        try:
+            item = input_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is None: return
+        yield item[0]
+
+
+def _run_stage(pool, samples, output, ordered, stop, errors):
+    # 结果包装成(result, ), 用None表示结束
+    imap = pool.imap if ordered else pool.imap_unordered
+    try:
+        for result in imap(samples):
+            _put_until(output, (result, ), stop)
+        _put_until(output, None, stop)
+    except _PipelineStopped:
+        pass
+    except BaseException as error:  # pylint: disable=broad-except
+        errors.append(error)
+        stop.set()
+
+
+class Pipeline:
+    """由多个MapTaskPool串联而成的流水线, 比如decode -> transform -> encode.
+
+    stages (list): 每个元素为MapTaskPool, 或者MapTaskPool.get_pool的参数
+        (num_threads, task_class_or_fun, args, ...). 每个stage有自己的worker数
+        和初始化参数, 需要每个worker的参数不同时直接传入MapTaskPool.
+    queue_size (int): stage之间的队列长度. 队列满时上游的stage停止读取样本,
+        这样内存占用是有界的.
+    ordered (bool): 是否按照输入顺序返回结果.
+    """
+
+    def __init__(self, stages, queue_size=256, ordered=True):
+        assert len(stages) > 0 and queue_size > 0
+        self.pools = []
+        for stage in stages:
+            if not isinstance(stage, lib.util.MapTaskPool):
+                stage = lib.util.MapTaskPool.get_pool(*stage)
+            self.pools.append(stage)
+        self.queue_size = queue_size
+        self.ordered = ordered
+
+    @property
+    def metrics(self):
+        """每个stage的统计数据, utilization最高的stage通常就是瓶颈."""
+
+        return [pool.metrics for pool in self.pools]
+
+    def process(self, samples):
+        return list(self.imap(samples))
+
+    def imap(self, samples):
+        """流式处理样本. 每个stage由一个线程驱动, 线程之间通过有界队列连接."""
+
+        stop, errors, threads = threading.Event(), [], []
+        for pool in self.pools:
+            output = queue.Queue(self.queue_size)
+            thread = threading.Thread(
+                target=_run_stage,
+                args=(pool, samples, output, self.ordered, stop, errors),
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+            samples = _iter_stage(output, stop)
+        try:
+            yield from samples
+        except _PipelineStopped:
+            raise errors[0] from None
+        finally:
+            # 正常结束时所有线程已经退出, 否则通知所有stage停止
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def finish(self):
+        for pool in self.pools:
+            pool.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+    @staticmethod
+    def run(stages, samples, queue_size=256, ordered=True):
+        """函数版本的Pipeline, 处理完所有样本之后关闭各个stage."""
+
+        with Pipeline(stages, queue_size, ordered) as pipeline:
+            return pipeline.process(samples)
+
+
+if __name__ == "__main__":
+    pass
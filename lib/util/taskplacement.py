@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""TaskPool中worker进程的CPU绑定和原生线程数.
+
+cv2, numpy(OpenBLAS, MKL), OpenMP等库默认按照机器的CPU数启动自己的线程池. 32个
+worker在32核的机器上运行时, 每个worker又有32个线程, 总共上千个线程互相争抢CPU,
+吞吐量反而大幅下降. WorkerPlacement在worker进程中创建task之前设置:
+    * threads: 每个worker中原生线程池的大小. 默认为"auto", 即可用的CPU数除以
+      worker数, 保证所有worker的线程总数不超过CPU数.
+    * affinity: 将worker绑定到指定的CPU上, 减少进程在CPU之间迁移. "numa"时按照
+      NUMA节点轮流绑定, 由于Linux默认在第一次访问的节点上分配内存, worker的内存
+      也会留在本地节点上.
+
+线程数通过以下方式设置:
+    * OMP_NUM_THREADS等环境变量, 对之后加载的库以及worker启动的子进程有效.
+    * cv2.setNumThreads.
+    * threadpoolctl(如果安装了), 对已经加载的BLAS和OpenMP有效. fork方式启动的
+      worker继承了主进程中已经初始化的numpy, 只设置环境变量是不够的.
+
+这些都是进程级别的设置, 所以只用于backend为"process"的pool.
+"""
+
+import os
+import glob
+
+import cv2
+
+__all__ = ("WorkerPlacement", "apply_worker_limits", "get_available_cpus")
+
+_THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "BLIS_NUM_THREADS",
+)
+
+
+def get_available_cpus():
+    """当前进程可以使用的CPU, 考虑了taskset和cgroup的cpuset限制."""
+
+    if hasattr(os, "sched_getaffinity"): return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _parse_cpulist(text):
+    """解析/sys中"0-3,8-11"形式的CPU列表."""
+
+    cpus = []
+    for part in text.strip().split(","):
+        if not part: continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _get_numa_nodes(available):
+    """返回每个NUMA节点上可用的CPU. 没有NUMA信息时所有CPU作为一个节点."""
+
+    nodes = []
+    pattern = "/sys/devices/system/node/node[0-9]*/cpulist"
+    paths = glob.glob(pattern)
+    paths.sort(key=lambda p: int(os.path.basename(os.path.dirname(p))[4:]))
+    for path in paths:
+        with open(path, encoding="utf-8") as srcfile:
+            cpus = [c for c in _parse_cpulist(srcfile.read()) if c in available]
+        if cpus: nodes.append(cpus)
+    return nodes or [list(available)]
+
+
+def apply_worker_limits(cpus=None, threads=None):
+    """在worker进程中调用: 绑定到cpus上, 并将原生线程池的大小设为threads."""
+
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    if threads is None: return
+    for name in _THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    cv2.setNumThreads(threads)
+    try:
+        import threadpoolctl  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return
+    threadpoolctl.threadpool_limits(threads)
+
+
+class WorkerPlacement:
+    """worker的CPU绑定和原生线程数, 参考模块的说明.
+
+    affinity (str or list): None表示不绑定; "core"表示将可用的CPU平分给各个
+        worker; "numa"表示worker按照NUMA节点轮流绑定, 每个worker可以使用节点
+        上的所有CPU; 也可以是list, 第i项为第i个worker可以使用的CPU.
+    threads (int or str): 每个worker的原生线程数. "auto"表示worker可以使用的
+        CPU数除以共用这些CPU的worker数, 至少为1; None表示不限制.
+    """
+
+    def __init__(self, affinity=None, threads="auto"):
+        assert affinity in (None, "core", "numa") or \
+            isinstance(affinity, (list, tuple)), f"Unknown affinity: {affinity}"
+        assert threads is None or threads == "auto" or threads > 0
+        if isinstance(affinity, (list, tuple)):
+            affinity = tuple(tuple(sorted(cpus)) for cpus in affinity)
+        self.affinity = affinity
+        self.threads = threads
+
+    def __eq__(self, other):
+        if not isinstance(other, WorkerPlacement): return NotImplemented
+        return (self.affinity, self.threads) == (other.affinity, other.threads)
+
+    def __hash__(self):
+        return hash((self.affinity, self.threads))
+
+    def __repr__(self):
+        return f"WorkerPlacement({self.affinity!r}, {self.threads!r})"
+
+    def get_limits(self, num_workers):
+        """返回每个worker的(cpus, threads), cpus为None表示不绑定."""
+
+        available = get_available_cpus()
+        groups = [
+            self._get_cpus(i, num_workers, available)
+            for i in range(num_workers)
+        ]
+        limits = []
+        for cpus in groups:
+            threads = self.threads
+            if threads == "auto":
+                # 绑定到同样CPU上的worker平分这些CPU
+                threads = max(len(cpus or available) // groups.count(cpus), 1)
+            limits.append((cpus, threads))
+        return limits
+
+    def _get_cpus(self, worker_id, num_workers, available):
+        if self.affinity is None: return None
+        if self.affinity == "numa":
+            nodes = _get_numa_nodes(available)
+            return nodes[worker_id % len(nodes)]
+        if self.affinity == "core":
+            # 将available平分成num_workers段, worker比CPU多时轮流使用
+            count = len(available)
+            if num_workers > count: return [available[worker_id % count]]
+            start = worker_id * count // num_workers
+            return available[start:(worker_id + 1) * count // num_workers]
+        return list(self.affinity[worker_id % len(self.affinity)])
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,508 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""reduce操作的TaskPool, 总体的说明参考lib.util.multitask.
+
+样本按chunk分发给worker, 每个worker用自己的task累积结果. task类定义了combine
+时worker之间两两并行合并, 定义了accumulate_batch时每次用一个chunk调用. 指定
+key函数时样本按照hash(key(sample))分发给固定的worker. worker异常退出时部分
+结果已经丢失, 所以直接抛出异常并结束其余的worker.
+"""
+
+import time
+import queue
+import asyncio
+import itertools
+import threading
+import multiprocessing
+
+import lib.util
+from lib.util.taskcall import HEALTH_CHECK_INTERVAL
+from lib.util.taskcall import KeyedReduceCall
+from lib.util.taskcall import ReduceCall
+from lib.util.taskcall import TaskError
+from lib.util.taskcall import ajoin
+from lib.util.taskcall import create_queue
+from lib.util.taskcall import create_task
+from lib.util.taskcall import estimate_size
+from lib.util.taskcall import get_backend
+from lib.util.taskcall import get_length
+from lib.util.taskcall import get_limits
+from lib.util.taskcall import get_on_error
+from lib.util.taskcall import iter_samples
+from lib.util.taskcall import raise_inline
+from lib.util.taskcall import retry
+from lib.util.taskcall import should_measure
+from lib.util.taskcall import watch_queue
+
+__all__ = ("ReduceTaskPool", )
+
+
+def _call_accumulate(task, sample):
+    if isinstance(sample, tuple):
+        task.accumulate(*sample)
+    else:
+        task.accumulate(sample)
+
+
+def _accumulate_chunk(task, chunk, max_retries=0):
+    """返回处理失败的样本对应的TaskError.
+
+    优先使用批量接口, samples为样本组成的list, 其中的tuple不展开. 批量接口
+    失败时, 整个chunk作为一个错误返回. 注意重试之前task可能已经部分更新了.
+    """
+
+    if hasattr(task, "accumulate_batch"):
+        error = retry(lambda: task.accumulate_batch(chunk), max_retries)
+        return [error] if isinstance(error, TaskError) else []
+    errors = []
+    for sample in chunk:
+        error = retry(
+            lambda s=sample: _call_accumulate(task, s), max_retries)
+        if isinstance(error, TaskError): errors.append(error)
+    return errors
+
+
+class ReduceTaskWorker:
+    """worker的基类, 对应reduce操作. 子类需要同时继承Process或者Thread.
+
+    inboxes为每个worker各自的队列, 用于worker之间传递部分结果, worker_id为当前
+    worker在其中的序号.
+    """
+
+    def __init__(self, task_class, task_args, input_queue, output_queue,
+                 worker_id=0, inboxes=None, max_retries=0,
+                 limits=None):  # yapf: disable
+        super().__init__()
+        assert hasattr(task_class, "accumulate")
+        assert hasattr(task_class, "get_result")
+        self.task_class = task_class
+        self.task_args = task_args
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.worker_id = worker_id
+        self.inboxes = inboxes or [None]
+        self.max_retries = max_retries
+        self.limits = limits
+        # 线程没有退出码, 用这个标记区分正常退出和异常退出
+        self.exited = False
+
+    def run(self):
+        if self.limits: lib.util.apply_worker_limits(*self.limits)
+        task = create_task(self.task_class, self.task_args)
+        metrics = lib.util.WorkerMetrics(self.worker_id)
+        bytes_in = 0
+        # 输入为(sent_time, samples)形式的chunk, None表示退出. 每处理完一个
+        # chunk, 返回("ack", num_samples, elapsed, metrics, errors); 退出时
+        # 返回("result", result).
+        while True:
+            start = time.perf_counter()
+            chunk = self.input_queue.get()
+            metrics.idle_time += time.perf_counter() - start
+            if chunk is None: break
+            sent_time, chunk = chunk
+            metrics.queue_wait += max(time.time() - sent_time, 0.0)
+            start = time.perf_counter()
+            errors = _accumulate_chunk(task, chunk, self.max_retries)
+            elapsed = time.perf_counter() - start
+            metrics.task_time += elapsed
+            if should_measure(metrics.chunks + 1):
+                bytes_in = estimate_size(chunk[0])
+            metrics.bytes_in += bytes_in * len(chunk)
+            metrics.samples += len(chunk)
+            metrics.chunks += 1
+            metrics.tick()
+            message = ("ack", len(chunk), elapsed, metrics, errors)
+            self.output_queue.put(message)
+        if hasattr(task, "combine"):
+            self._combine(task)
+        else:
+            self.output_queue.put(("result", task.get_result()))
+        self.exited = True
+
+    def _combine(self, task):
+        """和其他worker两两合并结果, 最终结果由0号worker返回.
+
+        第k轮中, 序号为i * 2^(k+1) + 2^k的worker把结果发给序号为i * 2^(k+1)
+        的worker, 然后退出. 同一轮的合并是并行的, 总共需要log2(N)轮.
+        """
+
+        step, num_workers = 1, len(self.inboxes)
+        while step < num_workers:
+            if self.worker_id % (2 * step) != 0:
+                self.inboxes[self.worker_id - step].put(task.get_result())
+                return
+            if self.worker_id + step < num_workers:
+                task.combine(self.inboxes[self.worker_id].get())
+            step *= 2
+        self.output_queue.put(("result", task.get_result()))
+
+
+class ReduceTaskProcess(ReduceTaskWorker, multiprocessing.Process):
+    """进程类, 对应reduce操作."""
+
+
+class ReduceTaskThread(ReduceTaskWorker, threading.Thread):
+    """线程类, 对应reduce操作. 和MapTaskThread一样是daemon线程."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+
+
+class ReduceTaskPoolSingleThread:
+    """单进程TaskPool. 用于reduce操作."""
+
+    def __init__(self, task_class, task_args, task_name=None, max_retries=0,
+                 on_error="raise"):  # yapf: disable
+        assert hasattr(task_class, "accumulate")
+        assert hasattr(task_class, "get_result")
+        assert isinstance(task_args, list)
+        assert len(task_args) == 1
+        self.instance = create_task(task_class, task_args[0])
+        self.task_name = task_name or task_class.__name__
+        self.max_retries = max_retries
+        self.on_error = get_on_error(on_error)
+        self.errors = []
+        self.metrics = lib.util.PoolMetrics(self.task_name, "inline", 1)
+
+    # pylint: disable=unused-argument
+    def accumulate(self, samples, max_pending=None, chunksize=None):
+        # 单进程版本不需要max_pending, 这里对应多进程版本的接口.
+        # chunksize只在task类定义了accumulate_batch时有效.
+        tracker = lib.util.get_progress_tracker(total=get_length(samples))
+        head = f"Task {self.task_name} (single thread)"
+        tracker.set_description(head)
+        samples, chunksize = iter(samples), self._get_batch_size(chunksize)
+        while True:
+            chunk = list(itertools.islice(samples, chunksize))
+            if not chunk: break
+            self._accumulate_chunk(chunk)
+            tracker.update(len(chunk))
+        tracker.close()
+
+    async def aaccumulate(self, samples, max_pending=None, chunksize=None):
+        # 在当前线程中计算, 每处理完一个chunk让出一次event loop
+        if not hasattr(samples, "__aiter__"):
+            samples, chunksize = iter(samples), self._get_batch_size(chunksize)
+            while True:
+                chunk = list(itertools.islice(samples, chunksize))
+                if not chunk: break
+                self._accumulate_chunk(chunk)
+                await asyncio.sleep(0)
+            return
+        chunk, chunksize = [], self._get_batch_size(chunksize)
+        async for sample in samples:
+            chunk.append(sample)
+            if len(chunk) < chunksize: continue
+            self._accumulate_chunk(chunk)
+            chunk = []
+            await asyncio.sleep(0)
+        if chunk: self._accumulate_chunk(chunk)
+
+    def get_result(self):
+        # 这里结果是一个list, 和多进程版本保持一致
+        if hasattr(self.instance, "combine"): return self.instance.get_result()
+        return [self.instance.get_result()]
+
+    async def aget_result(self):
+        return self.get_result()
+
+    def terminate(self):
+        # 这里对应多进程版本的接口
+        pass
+
+    def _get_batch_size(self, chunksize):
+        if not hasattr(self.instance, "accumulate_batch"): return 1
+        return chunksize or 1024
+
+    def _accumulate_chunk(self, chunk):
+        metrics = self.metrics.workers[0]
+        start = time.perf_counter()
+        errors = _accumulate_chunk(self.instance, chunk, self.max_retries)
+        metrics.task_time += time.perf_counter() - start
+        self.errors.extend(errors)
+        if errors and self.on_error == "raise": raise_inline(errors[0])
+        metrics.samples += len(chunk)
+        metrics.chunks += 1
+        metrics.tick()
+
+
+class ReduceTaskPoolMultiThread:
+    """多进程TaskPool. 用于reduce操作. backend为"process"或者"thread".
+
+    key为None时所有worker共用一个输入队列, 否则每个worker有自己的输入队列,
+    样本按照key分发.
+    """
+
+    def __init__(self, task_class, task_args, task_name=None,
+                 backend="process", key=None, max_retries=0,
+                 on_error="raise", placement=None):  # yapf: disable
+        assert hasattr(task_class, "accumulate")
+        assert hasattr(task_class, "get_result")
+        assert isinstance(task_args, list)
+        assert len(task_args) > 0
+        assert backend in ("process", "thread")
+        self.backend = backend
+        self.key = key
+        self.on_error = get_on_error(on_error)
+        self.errors = []
+        if key is None:
+            self.input_queues = [create_queue(backend)] * len(task_args)
+        else:
+            self.input_queues = [create_queue(backend) for _ in task_args]
+        self.input_queue = self.input_queues[0]
+        self.output_queue = create_queue(backend)
+        self.combine = hasattr(task_class, "combine")
+        inboxes = None
+        if self.combine:
+            inboxes = [create_queue(backend) for _ in task_args]
+        self.task_name = task_name or task_class.__name__
+        self.metrics = lib.util.PoolMetrics(
+            self.task_name, backend, len(task_args))
+
+        worker_class = {
+            "process": ReduceTaskProcess,
+            "thread": ReduceTaskThread,
+        }[backend]
+        limits = get_limits(placement, backend, len(task_args))
+        self.processes = []
+        for worker_id, args in enumerate(task_args):
+            process = worker_class(
+                task_class,
+                args,
+                self.input_queues[worker_id],
+                self.output_queue,
+                worker_id,
+                inboxes,
+                max_retries,
+                limits[worker_id],
+            )
+            self.processes.append(process)
+            process.start()
+
+    @property
+    def num_workers(self):
+        return len(self.processes)
+
+    def accumulate(self, samples, max_pending=None, chunksize=None):
+        """将样本分发给子进程, 等到所有样本都处理完之后返回.
+
+        samples可以是任意iterable, 参数max_pending和chunksize的含义同
+        MapTaskPoolMultiThread.imap.
+        """
+
+        call = self._create_call(samples, max_pending, chunksize)
+        samples = iter(samples)
+        try:
+            while True:
+                call.feed(samples)
+                if call.finished: break
+                call.receive(self._get_message())
+        finally:
+            while call.pending:
+                call.receive(self._get_message())
+            call.close()
+        self._check_errors(call)
+
+    async def aaccumulate(self, samples, max_pending=None, chunksize=None):
+        """accumulate的asyncio版本, samples也可以是async iterable."""
+
+        call = self._create_call(samples, max_pending, chunksize)
+        messages, unwatch = watch_queue(self.output_queue)
+        samples = iter_samples(samples)
+        try:
+            while True:
+                await call.afeed(samples)
+                if call.finished: break
+                call.receive(await self._aget_message(messages))
+        finally:
+            while call.pending:
+                call.receive(await self._aget_message(messages))
+            unwatch()
+            call.close()
+        self._check_errors(call)
+
+    def get_result(self):
+        """返回reduce的结果.
+
+        默认为每个worker的结果组成的list. 若task类定义了combine, 则worker之间
+        先两两合并, 这里直接返回最终结果.
+        """
+
+        self._stop_workers()
+        num_results = 1 if self.combine else len(self.processes)
+        results = [self._get_message()[1] for _ in range(num_results)]
+        # 结果已经全部取回, 子进程中的queue为空, join不会死锁
+        for proc in self.processes:
+            proc.join()
+        return results[0] if self.combine else results
+
+    async def aget_result(self):
+        self._stop_workers()
+        num_results = 1 if self.combine else len(self.processes)
+        messages, unwatch = watch_queue(self.output_queue)
+        try:
+            results = [(await self._aget_message(messages))[1]
+                       for _ in range(num_results)]
+        finally:
+            unwatch()
+        await ajoin(self.processes)
+        return results[0] if self.combine else results
+
+    def _check_errors(self, call):
+        self.errors.extend(call.errors)
+        if call.errors and self.on_error == "raise": raise call.errors[0]
+
+    def _check_workers(self):
+        # 合并结果时worker会正常退出, 所以这里只检查异常退出的worker. 部分结果
+        # 已经随着worker一起丢失, 无法恢复, 只能抛出异常.
+        for worker_id, process in enumerate(self.processes):
+            if process.is_alive(): continue
+            # 进程检查退出码, 线程检查run是否正常结束
+            exitcode = getattr(process, "exitcode", None)
+            if exitcode == 0 or (exitcode is None and process.exited): continue
+            # 其余的worker也无法继续使用, 这里直接结束它们
+            self.terminate()
+            lib.util.log_and_raise_exception(
+                f"Worker {worker_id} of {self.task_name} exited unexpectedly "
+                f"(exitcode: {exitcode}), its partial result is lost.")
+
+    def _get_message(self):
+        while True:
+            try:
+                return self.output_queue.get(timeout=HEALTH_CHECK_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+
+    async def _aget_message(self, messages):
+        while True:
+            try:
+                return await asyncio.wait_for(
+                    messages.get(), HEALTH_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                self._check_workers()
+
+    def _create_call(self, samples, max_pending, chunksize):
+        assert all(q.empty() for q in self.input_queues)
+        assert self.output_queue.empty()
+        if self.key is None:
+            return ReduceCall(self, samples, max_pending, chunksize)
+        return KeyedReduceCall(self, samples, max_pending, chunksize)
+
+    def _stop_workers(self):
+        assert all(q.empty() for q in self.input_queues)
+        assert self.output_queue.empty()
+
+        # 传递None让子进程退出, 子进程退出之前返回结果或者和其他进程合并结果
+        for input_queue in self.input_queues:
+            input_queue.put(None)
+
+    def terminate(self):
+        """出错之后结束所有worker, 部分结果被丢弃."""
+
+        if self.backend == "process":
+            for process in self.processes:
+                if process.is_alive(): process.terminate()
+                process.join()
+            return
+        # 线程不能被强制结束, 让它们处理完手上的chunk之后退出. 合并结果时
+        # 可能在等待已经退出的worker, 这些线程是daemon, 不会阻塞解释器退出
+        for input_queue in self.input_queues:
+            input_queue.put(None)
+
+
+class ReduceTaskPool:
+    """用于reduce操作的TaskPool入口."""
+
+    def __init__(self, task_class, task_args, task_name=None, backend=None,
+                 key=None, max_retries=0, on_error="raise",
+                 placement=None):  # yapf: disable
+        assert hasattr(task_class, "accumulate")
+        assert hasattr(task_class, "get_result")
+        assert isinstance(task_args, list)
+        assert len(task_args) > 0
+        backend = get_backend(backend, len(task_args))
+        # 只有一个worker时, 所有的key都由它负责, 不需要分发
+        if backend == "inline":
+            self.task_pool = ReduceTaskPoolSingleThread(
+                task_class, task_args[:1], task_name, max_retries,
+                on_error)  # yapf: disable
+        else:
+            self.task_pool = ReduceTaskPoolMultiThread(
+                task_class, task_args, task_name, backend, key, max_retries,
+                on_error, placement)  # yapf: disable
+
+    @property
+    def metrics(self):
+        return self.task_pool.metrics
+
+    @property
+    def errors(self):
+        """处理失败的样本对应的TaskError, on_error为"return"时使用."""
+
+        return self.task_pool.errors
+
+    def accumulate(self, samples, max_pending=None, chunksize=None):
+        self.task_pool.accumulate(samples, max_pending, chunksize)
+
+    async def aaccumulate(self, samples, max_pending=None, chunksize=None):
+        await self.task_pool.aaccumulate(samples, max_pending, chunksize)
+
+    def get_result(self):
+        return self.task_pool.get_result()
+
+    async def aget_result(self):
+        return await self.task_pool.aget_result()
+
+    def terminate(self):
+        """出错之后结束所有worker. 之后不能再调用accumulate和get_result."""
+
+        self.task_pool.terminate()
+
+    @staticmethod
+    def reduce(num_threads, task_class, samples, task_args=tuple(),
+               task_name=None, backend=None, key=None, max_retries=0,
+               on_error="raise", placement=None):  # yapf: disable
+        """函数版本的reduce.
+
+        key (function): 若不为None, 则样本按照hash(key(sample))分发给固定的
+            worker. samples也可以是MapTaskPool.imap的输出.
+        max_retries, on_error, placement: 同MapTaskPool.get_pool.
+        """
+
+        # 和map版本不同的是, reduce版本只支持class方式.
+        task_args = [task_args] * num_threads
+        task_name = task_name or task_class.__name__
+        pool = ReduceTaskPool(
+            task_class, task_args, task_name, backend, key, max_retries,
+            on_error, placement)  # yapf: disable
+        try:
+            pool.accumulate(samples)
+            return pool.get_result()
+        except BaseException:
+            # 出错时worker还在等待样本, 不结束的话解释器无法退出
+            pool.terminate()
+            raise
+
+    @staticmethod
+    async def areduce(num_threads, task_class, samples, task_args=tuple(),
+                      task_name=None, backend=None, key=None, max_retries=0,
+                      on_error="raise", placement=None):  # yapf: disable
+        """reduce的asyncio版本."""
+
+        task_args = [task_args] * num_threads
+        task_name = task_name or task_class.__name__
+        pool = ReduceTaskPool(
+            task_class, task_args, task_name, backend, key, max_retries,
+            on_error, placement)  # yapf: disable
+        try:
+            await pool.aaccumulate(samples)
+            return await pool.aget_result()
+        except BaseException:
+            pool.terminate()
+            raise
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+# pylint: disable=unused-import
+# pylint: disable=wrong-import-order
+
+"""multitask的性能测试.
+
+overhead测试每次调用pool的固定开销. throughput在worker数, 样本大小, 任务耗时
+几个维度上测量MapTaskPool和ReduceTaskPool的吞吐量, 并和multiprocessing.Pool,
+concurrent.futures对比, 吞吐量都不包含pool的启动时间. 结果可以保存为
+baseline, 之后再运行时和baseline比较, 吞吐量下降超过tolerance的case会被标记
+出来, 并且返回非零的退出码. worker数为1时MapTaskPool使用单进程版本, 对应
+single和multi process的对比.
+
+用法:
+    python tools/benchmark_multitask.py --mode throughput --save base.json
+    python tools/benchmark_multitask.py --mode throughput --baseline base.json
+"""
+
+import sys
+import time
+import logging
+import argparse
+import functools
+import itertools
+import statistics
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+
+import init
+import lib.util
+
+
+def add_one(value):
+    return value + 1
+
+
+def spin(sample, cost):
+    """模拟耗时为cost秒的计算任务, 原样返回样本."""
+
+    deadline = time.perf_counter() + cost
+    while time.perf_counter() < deadline:
+        pass
+    return sample
+
+
+def make_sample(payload):
+    """payload为0时样本是一个整数, 否则为payload字节的numpy数组."""
+
+    if payload == 0: return 1
+    return np.ones(payload, dtype=np.uint8)
+
+
+def get_num_samples(max_samples, payload, max_bytes=256 << 20):
+    # 大样本时减少样本数, 避免单个case耗时太长
+    if payload == 0: return max_samples
+    return int(max(8, min(max_samples, max_bytes // payload)))
+
+
+class SumTask:
+
+    def __init__(self):
+        self.total = 0
+
+    def accumulate(self, value):
+        self.total += value
+
+    def get_result(self):
+        return self.total
+
+
+class SizeTask:
+
+    def __init__(self, cost):
+        self.cost = cost
+        self.total = 0
+
+    def accumulate(self, sample):
+        spin(None, self.cost)
+        self.total += getattr(sample, "nbytes", 0)
+
+    def get_result(self):
+        return self.total
+
+
+def measure(function, repeat):
+    """返回多次调用`function`的耗时中位数, 单位为毫秒."""
+
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed.append((time.perf_counter() - start) * 1000)
+    return statistics.median(elapsed)
+
+
+def bench_call_overhead(num_threads, num_samples, repeat):
+    """测量每次调用pool的固定开销, 样本很少, 任务很轻."""
+
+    samples = list(range(num_samples))
+    pool = lib.util.MapTaskPool.get_pool(num_threads, add_one)
+    value = measure(lambda: pool.process(samples), repeat)
+    pool.finish()
+    logging.info("MapTaskPool.process (reused pool): %.2fms", value)
+
+    value = measure(
+        lambda: lib.util.MapTaskPool.map(num_threads, add_one, samples),
+        repeat,
+    )
+    logging.info("MapTaskPool.map (new pool per call): %.2fms", value)
+
+    value = measure(
+        lambda: lib.util.ReduceTaskPool.reduce(num_threads, SumTask, samples),
+        repeat,
+    )
+    logging.info("ReduceTaskPool.reduce (new pool per call): %.2fms", value)
+
+
+def bench_map(impl, num_workers, samples, cost, repeat):
+    """返回一种map实现的耗时(毫秒). pool的创建不计入耗时."""
+
+    fun = functools.partial(spin, cost=cost)
+    if impl in ("taskpool", "taskpool-shm"):
+        transport = "shm" if impl == "taskpool-shm" else None
+        pool = lib.util.MapTaskPool.get_pool(
+            num_workers, spin, cost, transport=transport)
+        value = measure(lambda: pool.process(samples), repeat)
+        pool.finish()
+    elif impl == "mp.Pool":
+        with multiprocessing.Pool(num_workers) as pool:
+            value = measure(lambda: pool.map(fun, samples), repeat)
+    elif impl == "futures":
+        with concurrent.futures.ProcessPoolExecutor(num_workers) as pool:
+            # chunksize和multiprocessing.Pool.map的默认策略保持一致
+            size = max(1, len(samples) // (4 * num_workers))
+            value = measure(
+                lambda: list(pool.map(fun, samples, chunksize=size)),
+                repeat,
+            )
+    else:
+        raise ValueError(f"Unknown implementation: {impl}")
+    return value
+
+
+def bench_reduce(num_workers, samples, cost, repeat):
+    """返回reduce的耗时(毫秒). 和bench_map一样, pool的启动不计入耗时.
+
+    get_result之后pool就结束了, 所以每次都要创建新的pool. 创建pool并且每个
+    worker处理完一个样本(worker已经初始化好)之前的时间作为启动时间, 单独输出.
+    """
+
+    task_args = [cost] * num_workers
+    startup, elapsed = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pool = lib.util.ReduceTaskPool(SizeTask, task_args)
+        pool.accumulate([samples[0]] * num_workers, chunksize=1)
+        startup.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        pool.accumulate(samples)
+        pool.get_result()
+        elapsed.append((time.perf_counter() - start) * 1000)
+    logging.info(
+        "reduce/workers=%d: %.2fms startup", num_workers,
+        statistics.median(startup))  # yapf: disable
+    return statistics.median(elapsed)
+
+
+def bench_throughput(args):
+    """在各个维度上测量吞吐量, 返回{case: samples/s}."""
+
+    impls = ["taskpool", "taskpool-shm", "mp.Pool", "futures"]
+    results = {}
+    for workers, payload, cost in itertools.product(
+            args.workers, args.payloads, args.costs):  # yapf: disable
+        num_samples = get_num_samples(args.num_samples, payload)
+        samples = [make_sample(payload) for _ in range(num_samples)]
+        for impl in impls + ["reduce"]:
+            # 共享内存只对numpy数组有意义
+            if impl == "taskpool-shm" and payload == 0: continue
+            case = f"{impl}/workers={workers}/payload={payload}/cost={cost}"
+            if impl == "reduce":
+                value = bench_reduce(workers, samples, cost, args.repeat)
+            else:
+                value = bench_map(impl, workers, samples, cost, args.repeat)
+            results[case] = num_samples / value * 1000
+            logging.info("%s: %.1f samples/s", case, results[case])
+    return results
+
+
+def compare_baseline(results, baseline, tolerance):
+    """返回吞吐量比baseline下降超过tolerance的case."""
+
+    regressions = []
+    for case, value in results.items():
+        if case not in baseline: continue
+        ratio = value / baseline[case]
+        if ratio < 1 - tolerance:
+            regressions.append(case)
+            logging.warning(
+                "%s: %.1f -> %.1f samples/s (%.0f%%)",
+                case,
+                baseline[case],
+                value,
+                (ratio - 1) * 100,
+            )
+    return regressions
+
+
+def parse_list(text, vtype=int):
+    return [vtype(x) for x in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of multitask.")
+    parser.add_argument(
+        "--mode", default="overhead", choices=["overhead", "throughput"])
+    parser.add_argument("--num_threads", type=int, default=4)
+    parser.add_argument("--num_samples", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=20)
+    # 以下参数只用于throughput模式
+    parser.add_argument("--workers", type=parse_list, default=[1, 2, 4])
+    parser.add_argument(
+        "--payloads", type=parse_list, default=[0, 1 << 10, 1 << 20, 8 << 20])
+    parser.add_argument(
+        "--costs", type=functools.partial(parse_list, vtype=float),
+        default=[0.0, 0.001])  # yapf: disable
+    parser.add_argument("--save", help="将结果保存为baseline")
+    parser.add_argument("--baseline", help="和之前保存的baseline比较")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    if args.mode == "overhead":
+        bench_call_overhead(args.num_threads, args.num_samples, args.repeat)
+        return 0
+
+    results = bench_throughput(args)
+    if args.save: lib.util.write_json_file(results, args.save)
+    if not args.baseline: return 0
+    baseline = lib.util.read_json_file(args.baseline)
+    regressions = compare_baseline(results, baseline, args.tolerance)
+    logging.info("%d regressions in %d cases", len(regressions), len(results))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    lib.util.initialize_logger()
+    sys.exit(main())
@@ -4,12 +4,41 @@
 # pylint: disable=unused-import
 # pylint: disable=wrong-import-order
 
+import os
+import sys
+import glob
+import time
+import shutil
+import socket
+import asyncio
 import unittest
+import tempfile
+import threading
+import weakref
+import subprocess
+import importlib.util
+import collections
+import multiprocessing
+import multiprocessing.connection
+
+import numpy as np
 
 import init
 import lib.util
 
 
+def get_worker_id(_):
+    return os.getpid(), threading.get_ident()
+
+
+_COMPUTED_SAMPLES = []
+
+
+def double_and_record(x):
+    _COMPUTED_SAMPLES.append(x)
+    return x * 2
+
+
 class TestMultiTask(unittest.TestCase):
 
     def test_function_args_none(self):
@@ -147,6 +176,898 @@ class TestMultiTask(unittest.TestCase):
         self.assertEqual(result, [0] * 10)
         pool.finish()
 
+    def test_imap_generator(self):
+        for num_threads in (1, 4):
+            pool = lib.util.TaskPool.get_pool(num_threads, lambda x: x * 2)
+            samples = (x for x in range(100))
+            result = list(pool.imap(samples, max_pending=8))
+            self.assertEqual(result, [x * 2 for x in range(100)])
+            result = list(pool.imap_unordered(range(100), max_pending=8))
+            self.assertEqual(sorted(result), [x * 2 for x in range(100)])
+            pool.finish()
+
+    def test_imap_early_stop(self):
+        pool = lib.util.TaskPool.get_pool(4, lambda x: x + 1)
+        for result in pool.imap(range(100)):
+            if result == 10: break
+        # 提前退出之后, pool仍然可以继续使用
+        self.assertEqual(pool.process(list(range(10))), list(range(1, 11)))
+        pool.finish()
+
+    def test_chunked_dispatch(self):
+        pool = lib.util.TaskPool.get_pool(4, lambda x: x * 2)
+        for chunksize in (None, 1, 7, 1000):
+            result = pool.process(list(range(1000)), chunksize=chunksize)
+            self.assertEqual(result, [x * 2 for x in range(1000)])
+        pool.finish()
+
+    def test_chunk_sizer(self):
+        # pylint: disable=protected-access
+        sizer = lib.util.taskcall.ChunkSizer(4, num_samples=100000)
+        self.assertEqual(sizer.chunksize, 1)
+        # 任务很轻时chunk变大, 但是受max_chunksize的限制
+        sizer.update(10, 1e-5)
+        self.assertEqual(sizer.chunksize, 1024)
+        # 样本数据量很大时chunk变小
+        sizer.probe(b"x" * (4 << 20))
+        self.assertEqual(sizer.chunksize, 1)
+
+    def test_reduce(self):
+
+        class TestClass:
+
+            def __init__(self):
+                self.total = 0
+
+            def accumulate(self, x, y):
+                self.total += x * y
+
+            def get_result(self):
+                return self.total
+
+        for num_threads in (1, 4):
+            samples = ((x, 2) for x in range(100))
+            result = lib.util.ReduceTaskPool.reduce(
+                num_threads, TestClass, samples)  # yapf: disable
+            self.assertEqual(len(result), num_threads)
+            self.assertEqual(sum(result), 9900)
+
+    def test_call_overhead(self):
+        # 原来的实现每次调用至少sleep 1秒
+        start = time.time()
+        for _ in range(10):
+            lib.util.TaskPool.map(4, lambda x: x + 1, list(range(10)))
+        self.assertLess(time.time() - start, 5)
+
+    def test_shared_memory_transport(self):
+        images = [np.full((64, 64, 3), i, dtype=np.uint8) for i in range(20)]
+        transport = lib.util.SharedArrayTransport(threshold=1024)
+        result = lib.util.TaskPool.map(
+            num_threads=4,
+            task_class_or_fun=lambda x: (x.sum(), x[:, :, 0] + 1),
+            samples=images,
+            transport=transport,
+        )
+        for i, (total, image) in enumerate(result):
+            self.assertEqual(total, i * 64 * 64 * 3)
+            self.assertEqual(image.shape, (64, 64))
+            self.assertTrue((image == i + 1).all())
+        # 所有的共享内存文件都已经被删除
+        pattern = os.path.join("/dev/shm", transport.prefix + "*")
+        self.assertEqual(glob.glob(pattern), [])
+
+    def test_backends(self):
+
+        class TestClass:
+
+            def __init__(self, value):
+                self.value = value
+
+            def process(self, num):
+                return self.value + num
+
+        for backend in ("process", "thread", "inline"):
+            pool = lib.util.TaskPool(TestClass, [1, 1, 1], backend=backend)
+            result = pool.process(list(range(100)))
+            self.assertEqual(result, list(range(1, 101)))
+            pool.finish()
+
+            result = lib.util.TaskPool.map(
+                num_threads=3,
+                task_class_or_fun=TestClass,
+                samples=list(range(10)),
+                args=2,
+                backend=backend,
+            )
+            self.assertEqual(result, list(range(2, 12)))
+
+        # 没有finish的线程pool不会阻塞解释器退出
+        code = ("import init, lib.util\n"
+                "class Task:\n"
+                "    accumulate = get_result = lambda self, *args: None\n"
+                "lib.util.TaskPool.get_pool(2, abs, backend='thread')\n"
+                "lib.util.ReduceTaskPool(Task, [()] * 2, backend='thread')\n")
+        subprocess.run([sys.executable, "-c", code], check=True, timeout=30,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_reduce_thread_backend(self):
+
+        class TestClass:
+
+            def __init__(self):
+                self.samples = []
+
+            def accumulate(self, sample):
+                self.samples.append(sample)
+
+            def get_result(self):
+                return self.samples
+
+        result = lib.util.ReduceTaskPool.reduce(
+            4, TestClass, range(100), backend="thread")  # yapf: disable
+        self.assertEqual(len(result), 4)
+        self.assertEqual(sorted(sum(result, [])), list(range(100)))
+
+    def test_asyncio_map(self):
+
+        async def generate(num):
+            for x in range(num):
+                yield x
+                await asyncio.sleep(0)
+
+        async def run(backend):
+            pool = lib.util.TaskPool.get_pool(
+                3, lambda x: x * 2, backend=backend)  # yapf: disable
+            # 两个pool同时在同一个event loop中工作
+            other = lib.util.TaskPool.get_pool(
+                2, lambda x: x + 1, backend=backend)  # yapf: disable
+            results = await asyncio.gather(
+                pool.aprocess(list(range(100))),
+                other.aprocess(list(range(100))),
+            )
+            streamed = [r async for r in pool.aimap_unordered(generate(50))]
+            await pool.afinish()
+            await other.afinish()
+            return results, streamed
+
+        for backend in ("process", "thread", "inline"):
+            (first, second), streamed = asyncio.run(run(backend))
+            self.assertEqual(first, [x * 2 for x in range(100)])
+            self.assertEqual(second, [x + 1 for x in range(100)])
+            self.assertEqual(sorted(streamed), [x * 2 for x in range(50)])
+
+        def fail(x):
+            if x == 3: raise ValueError(x)
+            return x
+
+        # 出错时amap也会关闭pool
+        children = set(multiprocessing.active_children())
+        with self.assertRaises(lib.util.TaskError):
+            asyncio.run(lib.util.TaskPool.amap(2, fail, list(range(10))))
+        self.assertEqual(set(multiprocessing.active_children()), children)
+
+    def test_asyncio_reduce(self):
+
+        class TestClass:
+
+            def __init__(self):
+                self.total = 0
+
+            def accumulate(self, x):
+                self.total += x
+
+            def get_result(self):
+                return self.total
+
+        for num_threads in (1, 4):
+            result = asyncio.run(
+                lib.util.ReduceTaskPool.areduce(
+                    num_threads, TestClass, range(100)))  # yapf: disable
+            self.assertEqual(sum(result), 4950)
+
+    def test_warm_pool(self):
+        # pylint: disable=protected-access
+        for backend in ("process", "thread"):
+            pids = []
+            for _ in range(3):
+                result = lib.util.TaskPool.map(
+                    num_threads=2,
+                    task_class_or_fun=get_worker_id,
+                    samples=list(range(20)),
+                    backend=backend,
+                    keep_alive=0.5,
+                )
+                pids.append(set(result))
+            # 三次调用使用的是同一组worker
+            self.assertLessEqual(len(set.union(*pids)), 2)
+        self.assertEqual(len(lib.util.multitask._warm_pools.idle), 2)
+        time.sleep(1)
+        self.assertEqual(len(lib.util.multitask._warm_pools.idle), 0)
+
+        with lib.util.TaskPool.warm_pool(2, get_worker_id) as pool:
+            pool.process(list(range(10)))
+        # lambda不能pickle, 参数中有不能hash的list时也可以复用
+        fun = lambda x, a, b: x + a + b[0]
+        for _ in range(2):
+            result = lib.util.TaskPool.map(
+                2, fun, [1, 2], args=(1, [2]), backend="thread", keep_alive=1)
+            self.assertEqual(result, [4, 5])
+        self.assertEqual(len(lib.util.multitask._warm_pools.idle), 2)
+        lib.util.TaskPool.shutdown_warm_pools()
+        self.assertEqual(len(lib.util.multitask._warm_pools.idle), 0)
+
+        # shared按对象区分, 空闲的pool的key持有shared, 所以id不会被复用
+        fun = lambda x, shared: int(shared[x])
+        for backend in ("process", "thread"):
+            table = np.arange(4)
+            table_ref = weakref.ref(table)
+            for _ in range(2):
+                result = lib.util.TaskPool.map(
+                    2, fun, [1, 2], backend=backend, shared=table,
+                    keep_alive=1)  # yapf: disable
+                self.assertEqual(result, [1, 2])
+            del table
+            self.assertIsNotNone(table_ref())
+        self.assertEqual(len(lib.util.multitask._warm_pools.idle), 2)
+        lib.util.TaskPool.shutdown_warm_pools()
+
+    def test_reduce_combine(self):
+
+        class TestClass:
+
+            def __init__(self):
+                self.counter = collections.Counter()
+
+            def accumulate(self, sample):
+                self.counter[sample % 7] += 1
+
+            def combine(self, result):
+                self.counter.update(result)
+
+            def get_result(self):
+                return self.counter
+
+        expected = collections.Counter(x % 7 for x in range(1000))
+        for num_threads in (1, 2, 5, 8):
+            for backend in ("process", "thread"):
+                result = lib.util.ReduceTaskPool.reduce(
+                    num_threads, TestClass, range(1000), backend=backend)
+                self.assertEqual(result, expected)
+
+    def test_reduce_accumulate_batch(self):
+
+        class TestClass:
+
+            def __init__(self):
+                self.histogram = np.zeros(10, dtype=np.int64)
+                self.num_batches = 0
+
+            def accumulate(self, sample):
+                raise NotImplementedError
+
+            def accumulate_batch(self, samples):
+                self.histogram += np.bincount(samples, minlength=10)
+                self.num_batches += 1
+
+            def get_result(self):
+                return self.histogram, self.num_batches
+
+        samples = [x % 10 for x in range(10000)]
+        for num_threads in (1, 4):
+            pool = lib.util.ReduceTaskPool(TestClass, [tuple()] * num_threads)
+            pool.accumulate(samples, chunksize=100)
+            result = pool.get_result()
+            histogram = sum(h for h, _ in result)
+            self.assertEqual(histogram.tolist(), [1000] * 10)
+            self.assertEqual(sum(n for _, n in result), 100)
+
+    def test_reduce_keyed(self):
+
+        class TestClass:
+
+            def __init__(self):
+                self.counter = collections.Counter()
+
+            def accumulate(self, barcode, value):
+                self.counter[barcode] += value
+
+            def get_result(self):
+                return self.counter
+
+        barcodes = [f"barcode{x % 37}" for x in range(1000)]
+        map_pool = lib.util.TaskPool.get_pool(2, lambda x: (x, 1))
+        for backend in ("process", "thread"):
+            result = lib.util.ReduceTaskPool.reduce(
+                num_threads=4,
+                task_class=TestClass,
+                samples=map_pool.imap_unordered(barcodes),
+                backend=backend,
+                key=lambda sample: sample[0],
+            )
+            # 每个worker负责的key互不相交
+            keys = [set(counter) for counter in result]
+            self.assertEqual(sum(len(k) for k in keys), 37)
+            self.assertEqual(
+                collections.Counter(barcodes),
+                sum(result, collections.Counter()),
+            )
+        map_pool.finish()
+
+    def test_cost_scheduling(self):
+        order = []
+
+        def fun(x):
+            order.append(x)
+            return x * 2
+
+        # 只有一个worker并且chunk大小为1时, 处理顺序就是分发的顺序
+        samples = [1, 5, 2, 4, 3]
+        pool = lib.util.TaskPool.get_pool(1, fun, backend="thread")
+        self.addCleanup(pool.finish)
+        results = pool.process(samples, chunksize=1, cost=lambda x: x)
+        self.assertEqual(results, [x * 2 for x in samples])
+        self.assertEqual(order, [5, 4, 3, 2, 1])
+
+        # 第一次运行记录处理时间, 之后按照记录的时间调度. 实测的时间有抖动,
+        # 这里直接写入记录, 只检查调度的顺序
+        with tempfile.TemporaryDirectory() as root:
+            os.environ["TASKPOOL_CACHE_DIR"] = root
+            try:
+                pool.process(samples, chunksize=1, cost=True)
+                self.assertTrue(os.path.exists(f"{root}/costs/fun.json"))
+                model = lib.util.multitask._CostModel("fun")
+                model.update(samples, [x * 0.01 for x in samples])
+                self.assertEqual(model.estimate([9, 4]), [0.03, 0.04])
+                order.clear()
+                results = pool.process(samples, chunksize=1, cost=True)
+            finally:
+                del os.environ["TASKPOOL_CACHE_DIR"]
+        self.assertEqual(results, [x * 2 for x in samples])
+        self.assertEqual(order, [5, 4, 3, 2, 1])
+
+    def test_pipeline(self):
+
+        def add(x, y):
+            return x + y
+
+        stages = [(2, add, 1), (1, add, 10), (2, add, 100)]
+        results = lib.util.Pipeline.run(stages, range(30), queue_size=4)
+        self.assertEqual(results, [x + 111 for x in range(30)])
+
+        # 三个stage同时运行: 第一个stage的最后一个样本等到第三个stage开始工作
+        # 之后才完成. 如果stage依次运行, 这里会等到超时
+        started, waited = threading.Event(), []
+
+        def first(x):
+            if x == 29: waited.append(started.wait(30))
+            return x + 1
+
+        def third(x):
+            started.set()
+            return x + 100
+
+        stages = [(2, first, (), None, None, "thread"),
+                  (1, add, 10, None, None, "thread"),
+                  (2, third, (), None, None, "thread")]  # yapf: disable
+        results = lib.util.Pipeline.run(stages, range(30), queue_size=4)
+        self.assertEqual(results, [x + 111 for x in range(30)])
+        self.assertEqual(waited, [True])
+
+        def fail(x):
+            if x == 7: raise ValueError(x)
+            return x
+
+        stages = [(2, lambda x: x), (2, fail, (), "fail", None, "thread")]
+        with lib.util.Pipeline(stages) as pipeline:
+            with self.assertRaises(lib.util.TaskError):
+                pipeline.process(range(100))
+
+    def test_metrics(self):
+
+        def sleep_add(x):
+            time.sleep(0.002)
+            return x + 1
+
+        for backend in ("process", "thread", "inline"):
+            num_threads = 1 if backend == "inline" else 2
+            pool = lib.util.TaskPool.get_pool(
+                num_threads, sleep_add, backend=backend)
+            pool.process(list(range(100)))
+            pool.finish()
+            summary = pool.metrics.summary()
+            self.assertEqual(summary["samples"], 100)
+            self.assertGreater(summary["task_time"], 0.15)
+            self.assertTrue(0 < summary["utilization"] <= 1)
+            self.assertEqual(len(pool.metrics.workers), num_threads)
+            # 数据量只是偶尔测量, 但是每个样本都计入
+            if backend != "inline":
+                self.assertGreaterEqual(summary["bytes_in"], 100)
+
+        with tempfile.TemporaryDirectory() as root:
+            pool.metrics.dump_json(f"{root}/metrics.json")
+            data = lib.util.read_json_file(f"{root}/metrics.json")
+            self.assertEqual(data["summary"]["samples"], 100)
+            pool.metrics.dump_prometheus(f"{root}/metrics.prom")
+            with open(f"{root}/metrics.prom") as srcfile:
+                text = srcfile.read()
+            self.assertIn('taskpool_samples{task="sleep_add"', text)
+
+    def test_broker(self):
+        # worker先于broker启动时等待broker
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            address = sock.getsockname()
+        # 每个worker的参数模拟本机的GPU编号
+        thread = threading.Thread(
+            target=lib.util.serve_map_workers,
+            args=(address, lambda x, gpu: (x * 2, gpu), [0, 1]),
+            kwargs={"authkey": b"test"},
+        )
+        thread.start()
+        time.sleep(0.3)
+        broker = lib.util.MapTaskBroker(address, b"test", num_workers=2)
+        try:
+            results = broker.process(list(range(100)))
+            self.assertEqual([r[0] for r in results], list(range(0, 200, 2)))
+            self.assertTrue({r[1] for r in results} <= {0, 1})
+            results = asyncio.run(broker.aprocess(list(range(10))))
+            self.assertEqual([r[0] for r in results], list(range(0, 20, 2)))
+            self.assertEqual(broker.metrics.summary()["samples"], 110)
+        finally:
+            broker.finish()
+            thread.join()
+        # finish之后不再接受连接
+        with self.assertRaises(ConnectionError):
+            multiprocessing.connection.Client(broker.address, authkey=b"test")
+
+        def crash_once(x, marker):
+            if x == 7 and not os.path.exists(marker):
+                open(marker, "w").close()
+                os._exit(1)
+            return x
+
+        # 远程worker退出之后, 它正在处理的chunk由其他worker处理
+        with tempfile.TemporaryDirectory() as root:
+            broker = lib.util.MapTaskBroker(
+                authkey=b"test", max_retries=1, heartbeat_timeout=2.0)
+            thread = threading.Thread(
+                target=lib.util.serve_map_workers,
+                args=(broker.address, crash_once,
+                      [os.path.join(root, "marker")] * 2),
+                kwargs={"authkey": b"test"},
+            )
+            thread.start()
+            try:
+                results = broker.process(list(range(20)), chunksize=2)
+            finally:
+                broker.finish()
+                thread.join()
+        self.assertEqual(results, list(range(20)))
+
+    def test_result_cache(self):
+        # 闭包中的变量属于函数的身份, 这里用全局的list记录计算过的样本
+        computed = _COMPUTED_SAMPLES
+        fun = double_and_record
+
+        with tempfile.TemporaryDirectory() as root:
+            cache = lib.util.ResultCache(root, version="v1")
+            for backend in ("thread", "inline"):
+                computed.clear()
+                results = lib.util.TaskPool.map(
+                    2, fun, list(range(10)), backend=backend, cache=cache)
+                self.assertEqual(results, list(range(0, 20, 2)))
+                results = lib.util.TaskPool.map(
+                    2, fun, list(range(12)), backend=backend, cache=cache)
+                self.assertEqual(results, list(range(0, 24, 2)))
+                # 第二次只计算新增的样本, 第二个backend全部命中
+                expected = list(range(12)) if backend == "thread" else []
+                self.assertEqual(sorted(computed), expected)
+
+            # 版本号变化之后不再命中
+            cache = lib.util.ResultCache(root, version="v2", max_bytes=0)
+            computed.clear()
+            lib.util.TaskPool.map(1, fun, [1, 2], cache=cache)
+            self.assertEqual(computed, [1, 2])
+            self.assertEqual(glob.glob(f"{root}/**/*.pkl", recursive=True), [])
+
+            # 名字相同的不同lambda不会共用结果
+            for offset in (1, 100):
+                results = lib.util.TaskPool.map(
+                    1, lambda x, a=offset: x + a, [1, 2], cache=root)
+                self.assertEqual(results, [1 + offset, 2 + offset])
+            for scale in (2, 3):
+                results = lib.util.TaskPool.map(
+                    1, lambda x, s=scale: x * s, [1, 2], cache=root)
+                self.assertEqual(results, [scale, scale * 2])
+            results = lib.util.TaskPool.map(
+                1, lambda x: x * 100, [1, 2], cache=root)
+            self.assertEqual(results, [100, 200])
+
+            # shared的内容也属于task的身份
+            def add_offset(x, shared):
+                return x + shared["offset"] + int(shared["table"].sum())
+
+            for backend in ("inline", "thread"):
+                for offset in (10, 1000):
+                    shared = {"offset": offset, "table": np.arange(offset)}
+                    results = lib.util.TaskPool.map(
+                        2, add_offset, [1, 2], shared=shared, cache=root,
+                        backend=backend)  # yapf: disable
+                    total = offset + int(np.arange(offset).sum())
+                    self.assertEqual(results, [1 + total, 2 + total])
+
+            # 默认的repr中包含内存地址, 不能作为key, 需要指定task_key
+            model = type("Model", (), {})()
+            with self.assertRaises(ValueError):
+                lib.util.TaskPool.map(
+                    2, lambda x, m: x, [1], args=model, cache=root,
+                    backend="thread")  # yapf: disable
+            cache = lib.util.ResultCache(root, task_key="model")
+            results = lib.util.TaskPool.map(
+                1, lambda x, m: x, [1], args=model, cache=cache)
+            self.assertEqual(results, [1])
+
+    def test_task_error(self):
+
+        def fun(x):
+            if x == 3: raise ValueError("bad sample")
+            return x
+
+        for backend in ("process", "thread", "inline"):
+            results = lib.util.TaskPool.map(
+                2, fun, list(range(10)), backend=backend, on_error="return")
+            self.assertIsInstance(results[3], lib.util.TaskError)
+            self.assertEqual(results[3].index, 3)
+            self.assertIn("bad sample", str(results[3]))
+            del results[3]
+            self.assertEqual(results, [0, 1, 2, 4, 5, 6, 7, 8, 9])
+            # inline版本直接抛出原来的异常
+            expected = ValueError if backend == "inline" else lib.util.TaskError
+            with self.assertRaises(expected) as context:
+                lib.util.TaskPool.map(2, fun, list(range(10)), backend=backend)
+            # 线程版本中保留原来的异常
+            if backend == "thread":
+                self.assertIsInstance(context.exception.__cause__, ValueError)
+
+        class TestClass:
+
+            def __init__(self):
+                self.total = 0
+
+            def accumulate(self, x):
+                if x == 3: raise ValueError("bad sample")
+                self.total += x
+
+            def get_result(self):
+                return self.total
+
+        pool = lib.util.ReduceTaskPool(
+            TestClass, [()] * 2, on_error="return")
+        pool.accumulate(range(10))
+        self.assertEqual(sum(pool.get_result()), 42)
+        self.assertEqual(len(pool.errors), 1)
+        result = lib.util.ReduceTaskPool.reduce(
+            2, TestClass, range(10), on_error="return")
+        self.assertEqual(sum(result), 42)
+        with self.assertRaises(ValueError):
+            lib.util.ReduceTaskPool.reduce(1, TestClass, range(10))
+        # 出错时reduce结束所有worker, 否则解释器无法退出
+        children = set(multiprocessing.active_children())
+        for backend in ("process", "thread"):
+            with self.assertRaises(lib.util.TaskError):
+                lib.util.ReduceTaskPool.reduce(
+                    2, TestClass, range(10), backend=backend)
+        self.assertEqual(set(multiprocessing.active_children()), children)
+        for thread in threading.enumerate():
+            if isinstance(thread, lib.util.taskreduce.ReduceTaskThread):
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+
+    def test_worker_crash(self):
+
+        def fun(x):
+            # 模拟cv2中的segfault
+            if x == 5: os._exit(1)
+            return x * 2
+
+        pool = lib.util.TaskPool.get_pool(2, fun, on_error="return")
+        results = pool.process(list(range(40)))
+        self.assertIsInstance(results[5], lib.util.TaskError)
+        self.assertEqual(results[:5], [0, 2, 4, 6, 8])
+        self.assertEqual(results[6:], list(range(12, 80, 2)))
+        # 重启之后的worker可以继续使用
+        self.assertEqual(pool.process([1, 2]), [2, 4])
+        results = asyncio.run(pool.aprocess(list(range(40))))
+        self.assertIsInstance(results[5], lib.util.TaskError)
+        self.assertEqual(results[6:], list(range(12, 80, 2)))
+        pool.finish()
+
+        def crash_once(x, marker):
+            if x == 380 and not os.path.exists(marker):
+                open(marker, "w").close()
+                os._exit(1)
+            return x
+
+        # 重启之前的统计数据仍然计入汇总
+        with tempfile.TemporaryDirectory() as root:
+            pool = lib.util.TaskPool.get_pool(
+                2, crash_once, os.path.join(root, "marker"), max_retries=1)
+            try:
+                results = pool.process(list(range(400)), chunksize=1)
+            finally:
+                pool.finish()
+        self.assertEqual(results, list(range(400)))
+        self.assertEqual(pool.metrics.summary()["samples"], 400)
+        self.assertGreater(pool.metrics.retired.samples, 0)
+
+        class TestClass:
+
+            def accumulate(self, x):
+                if x == 5: os._exit(1)
+
+            def get_result(self):
+                return None
+
+        pool = lib.util.ReduceTaskPool(TestClass, [()] * 2)
+        with self.assertRaises(Exception):
+            pool.accumulate(range(40))
+
+        class BrokenClass(TestClass):
+
+            def __init__(self):
+                raise ValueError("failed to initialize")
+
+        # 线程没有退出码, 也要能发现退出的worker
+        pool = lib.util.ReduceTaskPool(BrokenClass, [()] * 2, backend="thread")
+        with self.assertRaises(Exception):
+            pool.accumulate(range(40))
+
+    def test_shared_state(self):
+        table = np.arange(1 << 18, dtype=np.int64)
+
+        class TestClass:
+
+            def __init__(self, offset, shared):
+                self.offset = offset
+                self.table = shared["table"]
+
+            def process(self, x):
+                return int(self.table[x]) + self.offset
+
+        for backend in ("process", "thread", "inline"):
+            pool = lib.util.MapTaskPool(
+                TestClass, [0, 0], backend=backend, shared={"table": table})
+            self.assertEqual(pool.process([1, 5, 9]), [1, 5, 9])
+            pool.finish()
+        results = lib.util.TaskPool.map(
+            2, lambda x, shared: int(shared[x]) * 2, [3, 4], shared=table)
+        self.assertEqual(results, [6, 8])
+
+        # spawn方式启动的进程通过共享内存读取, 数组是只读的
+        state = lib.util.SharedState({"table": table, "name": "test"})
+        loaded = state.load()
+        self.assertEqual(loaded["name"], "test")
+        self.assertTrue((loaded["table"] == table).all())
+        self.assertFalse(loaded["table"].flags.writeable)
+        pattern = os.path.join("/dev/shm", state.transport.prefix + "*")
+        self.assertEqual(len(glob.glob(pattern)), 1)
+        state.close()
+        self.assertEqual(glob.glob(pattern), [])
+
+    def test_worker_placement(self):
+        cpus = lib.util.get_available_cpus()
+        limits = lib.util.WorkerPlacement().get_limits(2)
+        self.assertEqual(limits, [(None, max(len(cpus) // 2, 1))] * 2)
+        limits = lib.util.WorkerPlacement("core").get_limits(len(cpus))
+        self.assertEqual(limits, [([cpu], 1) for cpu in cpus])
+        # 绑定到同一个CPU上的worker平分线程数
+        placement = lib.util.WorkerPlacement([cpus[:1]])
+        self.assertEqual(placement.get_limits(3), [(cpus[:1], 1)] * 3)
+        placement = lib.util.WorkerPlacement(threads=3)
+        self.assertEqual(placement.get_limits(2), [(None, 3)] * 2)
+
+        environ = os.environ.get("OMP_NUM_THREADS")
+        results = lib.util.TaskPool.map(
+            2,
+            lambda _: (sorted(os.sched_getaffinity(0)),
+                       os.environ["OMP_NUM_THREADS"]),
+            list(range(4)),
+            placement=lib.util.WorkerPlacement([cpus[-1:]], threads=2),
+        )
+        self.assertEqual(results, [(cpus[-1:], "2")] * 4)
+        # 主进程中的设置不受影响
+        self.assertEqual(os.environ.get("OMP_NUM_THREADS"), environ)
+
+    def test_speculative_execution(self):
+
+        def fun(x, root):
+            # 第一次处理最后一个样本时卡住, 直到重新执行的一份完成. 没有推测
+            # 执行时, 这里会等到超时
+            first = os.path.join(root, "first")
+            done = os.path.join(root, "done")
+            if x == 19 and not os.path.exists(first):
+                open(first, "w").close()
+                for _ in range(3000):
+                    if os.path.exists(done): break
+                    time.sleep(0.01)
+            elif x == 19:
+                open(done, "w").close()
+            time.sleep(0.01)
+            return x * 2
+
+        with tempfile.TemporaryDirectory() as root:
+            for backend in ("process", "thread"):
+                os.makedirs(os.path.join(root, backend))
+                pool = lib.util.TaskPool.get_pool(
+                    2, fun, os.path.join(root, backend), backend=backend,
+                    speculate=3)  # yapf: disable
+                try:
+                    results = pool.process(list(range(20)))
+                    self.assertEqual(results, list(range(0, 40, 2)))
+                    self.assertGreaterEqual(pool.metrics.speculated, 1)
+                    # 落后的结果在之后的调用中被丢弃
+                    self.assertEqual(pool.process([1, 2]), [2, 4])
+                finally:
+                    pool.finish()
+
+
+class TestListFile(unittest.TestCase):
+
+    def test_read_list_file(self):
+        lines = ["# comment", "", "a  1 x", "  b 2 y  ", "#c 3 z", "d 4 w"]
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "list.txt")
+            with open(path, "w") as dstfile:
+                dstfile.write("\r\n".join(lines * 1000))
+            expected = [("a", "1", "x"), ("b", "2", "y"), ("d", "4", "w")]
+            self.assertEqual(
+                lib.util.read_list_file(path, " "), expected * 1000)
+            self.assertEqual(
+                list(lib.util.iter_list_file(path)),
+                ["a  1 x", "b 2 y", "d 4 w"] * 1000)
+            self.assertIsNone(
+                lib.util.iter_list_file(path + ".none", check=False))
+            # 并行解析的结果和逐行解析的一样
+            for num_workers in (1, 3):
+                self.assertEqual(
+                    lib.util.read_list_field(path, num_workers=num_workers),
+                    ["a", "b", "d"] * 1000)
+                self.assertEqual(
+                    lib.util.read_list_field(
+                        path, [2, 1], num_workers=num_workers),
+                    [["x", "1"], ["y", "2"], ["w", "4"]] * 1000)
+            # daemon进程中不能创建子进程, 这时顺序解析
+            with multiprocessing.Pool(1) as pool:
+                fields = pool.apply(
+                    lib.util.read_list_field, (path, ), {"num_workers": 3})
+            self.assertEqual(fields, ["a", "b", "d"] * 1000)
+            # 提前结束迭代时可以用with关闭文件
+            with lib.util.iter_list_file(path) as lines:
+                self.assertEqual(next(lines), "a  1 x")
+            with self.assertRaises(ValueError):
+                next(lines)
+
+    def test_read_list_columns(self):
+        lines = ["# name label score", "a 1 0.5", "b 2 1.5", "c 3 -2"]
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "list.txt")
+            lib.util.write_list_file(lines * 100, path)
+            cache_dir = os.path.join(root, "cache")
+            for num_workers in (1, 3):
+                names, labels, scores = lib.util.read_list_columns(
+                    path, [0, 1, 2], [str, np.int32, np.float32],
+                    num_workers=num_workers, cache_dir=cache_dir)
+                self.assertEqual(names.tolist(), ["a", "b", "c"] * 100)
+                self.assertEqual(labels.dtype, np.int32)
+                self.assertEqual(labels.tolist(), [1, 2, 3] * 100)
+                self.assertEqual(scores.tolist(), [0.5, 1.5, -2.0] * 100)
+            # 第二次读取命中缓存, 修改文件之后缓存失效
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            labels = lib.util.read_list_columns(
+                path, 1, np.int64, cache_dir=cache_dir)
+            self.assertEqual(labels.sum(), 600)
+            lib.util.write_list_file(["d 4 1"], path)
+            labels = lib.util.read_list_columns(
+                path, 1, np.int64, cache_dir=cache_dir)
+            self.assertEqual(labels.tolist(), [4])
+
+    def test_map_store(self):
+        lines = [f"k{i} {i % 7}" for i in range(1000)] + ["k3 9"]
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "map.txt")
+            lib.util.write_list_file(lines, path)
+            expected = lib.util.read_map_file(path, int)
+            store = lib.util.MapStore.build(
+                path, os.path.join(root, "store"), np.int64)
+            self.assertEqual(len(store), len(expected))
+            self.assertEqual(dict(store.items()), expected)
+            self.assertEqual(store["k3"], 9)
+            self.assertNotIn("k1000", store)
+            self.assertIsNone(store.get("k1000"))
+            with self.assertRaises(KeyError):
+                store["k1000"]  # pylint: disable=pointless-statement
+            values, found = store.lookup(["k5", "x", "k3"])
+            self.assertEqual(values.tolist(), [5, 0, 9])
+            self.assertEqual(found.tolist(), [True, False, True])
+            # worker中pickle之后重新映射同一个文件
+            store = lib.util.MapStore.build(path, os.path.join(root, "str"))
+            results = lib.util.TaskPool.map(
+                2, store.get, ["k1", "k3", "x"], backend="process")
+            self.assertEqual(results, ["1", "9", None])
+
+    def test_pickle_out_of_band(self):
+        data = {"image": np.arange(3 * 1000).reshape(3, 1000), "name": "x",
+                "sliced": np.arange(100)[::3]}  # yapf: disable
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "data.pkl")
+            buffers = lambda: glob.glob(path + ".*.buffers")
+            lib.util.write_pickle_file(data, path, out_of_band=True)
+            self.assertEqual(len(buffers()), 1)
+            result = lib.util.read_pickle_file(path)
+            self.assertEqual(result["name"], "x")
+            self.assertTrue((result["image"] == data["image"]).all())
+            self.assertTrue((result["sliced"] == data["sliced"]).all())
+            # 数组是写时复制的mmap视图, 修改不会影响文件
+            result["image"][0, 0] = -1
+            result = lib.util.read_pickle_file(path)
+            self.assertEqual(result["image"][0, 0], 0)
+            # 重新写入之后只留下新的.buffers文件
+            data["name"] = "y"
+            lib.util.write_pickle_file(data, path, out_of_band=True)
+            self.assertEqual(len(buffers()), 1)
+            self.assertEqual(lib.util.read_pickle_file(path)["name"], "y")
+            # 只复制了pickle文件时报错, 而不是返回header
+            single = os.path.join(root, "single.pkl")
+            shutil.copy(path, single)
+            with self.assertRaises(FileNotFoundError):
+                lib.util.read_pickle_file(single)
+            # 再用普通格式写入时去掉旧的.buffers文件
+            lib.util.write_pickle_file(data, path)
+            self.assertEqual(buffers(), [])
+            self.assertEqual(lib.util.read_pickle_file(path)["name"], "y")
+
+    def check_codec(self, root, ext):
+        lines = [f"a{i} {i}" for i in range(100)]
+        path = os.path.join(root, "list.txt" + ext)
+        lib.util.write_list_file(lines, path, level=1)
+        self.assertEqual(lib.util.read_list_file(path), lines)
+        self.assertEqual(
+            lib.util.read_list_field(path, 1, num_workers=2),
+            [str(i) for i in range(100)])
+        # protocol 2中的类按行读取, 解压的流需要支持readline
+        data = {"a": [1, 2], "counter": collections.Counter("aab")}
+        path = os.path.join(root, "data.pkl" + ext)
+        lib.util.write_pickle_file(data, path)
+        self.assertEqual(lib.util.read_pickle_file(path), data)
+        path = os.path.join(root, "data.json" + ext)
+        lib.util.write_json_file({"a": [1, 2]}, path)
+        self.assertEqual(lib.util.read_json_file(path), {"a": [1, 2]})
+        return path
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("zstandard"), "zstandard is not installed")
+    def test_zstd_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.check_codec(root, ".zst")
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("lz4"), "lz4 is not installed")
+    def test_lz4_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.check_codec(root, ".lz4")
+
+    def test_compressed_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            for ext in ("", ".gz", ".bz2", ".xz"):
+                path = self.check_codec(root, ext)
+            # 写入失败时不会留下不完整的文件, 原来的文件保持不变
+            with self.assertRaises(RuntimeError):
+                with lib.util.open_file(path, "w") as dstfile:
+                    dstfile.write("{")
+                    raise RuntimeError
+            self.assertEqual(lib.util.read_json_file(path), {"a": [1, 2]})
+            self.assertEqual(len(os.listdir(root)), 12)
+
 
 if __name__ == '__main__':
     unittest.main()